@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for c14n2py.
+
+Every case generates a synthetic document, parses it with minidom and
+measures DOMCanonicalizer.canonicalize throughput. By default each case runs
+in a separate interpreter, so peak memory of the case is not affected by the
+previous ones. Memory is reported as peak RSS (a high-water mark) of the case
+process after parsing and after canonicalization, canonicalization itself
+only shows up when it goes above the parsing peak. Where tracemalloc is
+available the peak of memory allocated during canonicalization is reported
+separately. Results are stored as JSON and can be compared run-to-run:
+
+    $ ./bench.py --output before.json
+    $ ./bench.py --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import logging
+import platform
+import subprocess
+import sys
+import time
+
+from xml.dom.minidom import parseString
+from c14n2py import DOMCanonicalizer, Parameters, QNameAwareParameter, \
+    QNameMatcher
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+SOAP_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+WSSE_NS = 'http://docs.oasis-open.org/wss/2004/01/' \
+          'oasis-200401-wss-wssecurity-secext-1.0.xsd'
+WSU_NS = 'http://docs.oasis-open.org/wss/2004/01/' \
+         'oasis-200401-wss-wssecurity-utility-1.0.xsd'
+DS_NS = 'http://www.w3.org/2000/09/xmldsig#'
+XSI_NS = 'http://www.w3.org/2001/XMLSchema-instance'
+
+
+def generate_wide(scale):
+    """ Flat document with many small children """
+    items = ''.join(
+        '<item n="{0}">value {0}</item>'.format(i) for i in range(scale * 2000)
+    )
+    return '<root>{}</root>'.format(items)
+
+
+def generate_deep(scale):
+    """ Single chain of nested elements """
+    depth = scale * 500
+    return '<e>' * depth + 'leaf' + '</e>' * depth
+
+
+def generate_namespaces(scale):
+    """ Many namespace declarations, redeclarations and prefixed names """
+    parts = ['<p0:root']
+    for i in range(20):
+        parts.append(' xmlns:p{0}="urn:ns:{0}"'.format(i))
+    parts.append('>')
+    for i in range(scale * 500):
+        p = i % 20
+        parts.append(
+            '<p{0}:a xmlns:q{1}="urn:q:{1}" p{2}:x="1" q{1}:y="2">'
+            '<p{2}:b xmlns:p{0}="urn:ns:{0}">t</p{2}:b></p{0}:a>'.format(
+                p, i % 7, (p + 1) % 20
+            )
+        )
+    parts.append('</p0:root>')
+    return ''.join(parts)
+
+
+def generate_attributes(scale):
+    """ Elements carrying many attributes """
+    attrs = ''.join(' a{0}="value &amp; {0}"'.format(i) for i in range(30))
+    items = ''.join(
+        '<item{} xmlns:n="urn:n" n:id="{}"/>'.format(attrs, i)
+        for i in range(scale * 200)
+    )
+    return '<root>{}</root>'.format(items)
+
+
+def generate_attribute_list(scale):
+    """ Elements with long attribute lists """
+    attrs = ''.join(' a{0}="{0}" n:b{0}="{0}"'.format(i) for i in range(200))
+    items = ''.join('<item{}/>'.format(attrs) for i in range(scale * 50))
+    return '<root xmlns:n="urn:n">{}</root>'.format(items)
+
+
+def generate_text(scale):
+    """ Single huge base64-like text node """
+    return '<data>{}</data>'.format('QUJDREVGR0g=' * (scale * 100000))
+
+
+def generate_wsse(scale):
+    """ WS-Security envelope with a signature and a large body """
+    body = ''.join(
+        '<m:item xmlns:m="urn:m" xsi:type="m:Type">'
+        '<m:name>name {0}</m:name><m:value>{0}</m:value></m:item>'.format(i)
+        for i in range(scale * 1000)
+    )
+    return (
+        '<soap:Envelope xmlns:soap="{soap}" xmlns:wsse="{wsse}" '
+        'xmlns:wsu="{wsu}" xmlns:xsi="{xsi}">'
+        '<soap:Header><wsse:Security>'
+        '<wsu:Timestamp wsu:Id="ts"><wsu:Created>2020-01-01T00:00:00Z'
+        '</wsu:Created></wsu:Timestamp>'
+        '<ds:Signature xmlns:ds="{ds}"><ds:SignedInfo>'
+        '<ds:Reference URI="#body"><ds:DigestValue>QUJD</ds:DigestValue>'
+        '</ds:Reference></ds:SignedInfo>'
+        '<ds:SignatureValue>QUJD</ds:SignatureValue></ds:Signature>'
+        '</wsse:Security></soap:Header>'
+        '<soap:Body wsu:Id="body">{body}</soap:Body></soap:Envelope>'
+    ).format(soap=SOAP_NS, wsse=WSSE_NS, wsu=WSU_NS, xsi=XSI_NS, ds=DS_NS,
+             body=body)
+
+
+def default_params():
+    return Parameters()
+
+
+def trim_params():
+    params = Parameters()
+    params.trimTextNodes = True
+    return params
+
+
+def sequential_params():
+    params = Parameters()
+    params.prefixRewrite = Parameters.SEQUENTIAL
+    return params
+
+
+def qname_params():
+    params = Parameters()
+    params.qnameAwareQualifiedAttributes.append(
+        QNameAwareParameter('type', XSI_NS)
+    )
+    return params
+
+
+def include_body(doc):
+    return [doc.getElementsByTagNameNS(SOAP_NS, 'Body')[0]], None
+
+
+def exclude_signature_list(doc):
+    return None, doc.getElementsByTagNameNS(DS_NS, 'Signature')
+
+
+def exclude_signature_matcher(doc):
+    return None, QNameMatcher('{%s}Signature' % DS_NS)
+
+
+# name -> (generator, parameters factory, include/exclude lists factory)
+CASES = [
+    ('wide', generate_wide, default_params, None),
+    ('wide-trim', generate_wide, trim_params, None),
+    ('deep', generate_deep, default_params, None),
+    ('namespaces', generate_namespaces, default_params, None),
+    ('namespaces-sequential', generate_namespaces, sequential_params, None),
+    ('attributes', generate_attributes, default_params, None),
+    ('attributes-sequential', generate_attributes, sequential_params, None),
+    ('attribute-list', generate_attribute_list, default_params, None),
+    ('attribute-list-sequential', generate_attribute_list, sequential_params,
+     None),
+    ('text', generate_text, default_params, None),
+    ('wsse', generate_wsse, default_params, None),
+    ('wsse-include-body', generate_wsse, default_params, include_body),
+    ('wsse-exclude-list', generate_wsse, default_params,
+     exclude_signature_list),
+    ('wsse-exclude-matcher', generate_wsse, default_params,
+     exclude_signature_matcher),
+    ('wsse-qname', generate_wsse, qname_params, None),
+    ('wsse-sequential', generate_wsse, sequential_params, None),
+]
+
+
+def count_nodes(doc):
+    """ Counts elements, attributes and character data nodes """
+    count = 0
+    stack = [doc]
+    while stack:
+        node = stack.pop()
+        count += 1
+        if node.attributes is not None:
+            count += len(node.attributes)
+        stack.extend(node.childNodes)
+    return count
+
+
+def max_rss_kb():
+    """ Peak resident set size of the current process in KB """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
+def run_case(name, scale, repeat):
+    """
+    Runs a single case in the current interpreter
+
+    :return: case results
+    :rtype: dict
+    """
+    generator, params_factory, lists_factory = [
+        case[1:] for case in CASES if case[0] == name
+    ][0]
+    data = generator(scale)
+    doc = parseString(data)
+    params = params_factory()
+    include_list, exclude_list = (None, None)
+    if lists_factory is not None:
+        include_list, exclude_list = lists_factory(doc)
+
+    parse_peak_rss = max_rss_kb()
+    if tracemalloc is not None:
+        tracemalloc.start()
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        DOMCanonicalizer.canonicalize(doc, params, include_list, exclude_list)
+        times.append(time.time() - start)
+    traced_peak = None
+    if tracemalloc is not None:
+        traced_peak = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    peak_rss = max_rss_kb()
+
+    seconds = min(times)
+    size = len(data)
+    nodes = count_nodes(doc)
+    return {
+        'bytes': size,
+        'nodes': nodes,
+        'seconds': seconds,
+        'mb_per_s': size / seconds / 1024 / 1024,
+        'nodes_per_s': nodes / seconds,
+        'parse_peak_rss_kb': parse_peak_rss,
+        'peak_rss_kb': peak_rss,
+        'traced_peak_kb': traced_peak,
+    }
+
+
+def run_isolated(name, scale, repeat):
+    """ Runs a single case in a separate interpreter """
+    output = subprocess.check_output([
+        sys.executable, __file__, '--run-case', name,
+        '--scale', str(scale), '--repeat', str(repeat),
+    ])
+    return json.loads(output.decode('utf-8'))
+
+
+def compare(results, previous, threshold):
+    """
+    Prints throughput changes against previous results
+
+    :return: names of regressed cases
+    :rtype: list[string]
+    """
+    regressions = []
+    for name, result in sorted(results['cases'].items()):
+        old = previous['cases'].get(name)
+        if old is None:
+            continue
+        change = result['mb_per_s'] / old['mb_per_s'] - 1
+        mark = ''
+        if change < -threshold:
+            mark = ' REGRESSION'
+            regressions.append(name)
+        print('{:<24} {:>10.3f} -> {:>10.3f} MB/s {:>+8.1%}{}'.format(
+            name, old['mb_per_s'], result['mb_per_s'], change, mark
+        ))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('cases', nargs='*', help='cases to run, all by default')
+    parser.add_argument('--scale', type=int, default=1,
+                        help='document size multiplier')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='canonicalizations per case, best time is used')
+    parser.add_argument('--output', help='store results to JSON file')
+    parser.add_argument('--compare', help='JSON file with previous results')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='throughput drop reported as regression')
+    parser.add_argument('--inline', action='store_true',
+                        help='run all cases in the current interpreter, peak RSS '
+                             'then includes the previous cases')
+    parser.add_argument('--list', action='store_true', help='list cases')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+
+    if args.run_case:
+        result = run_case(args.run_case, args.scale, args.repeat)
+        sys.stdout.write(json.dumps(result))
+        return 0
+
+    names = [case[0] for case in CASES]
+    if args.list:
+        print('\n'.join(names))
+        return 0
+    for name in args.cases:
+        if name not in names:
+            parser.error('unknown case: {}'.format(name))
+
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': args.scale,
+        'repeat': args.repeat,
+        'cases': {},
+    }
+    for name in args.cases or names:
+        if args.inline:
+            result = run_case(name, args.scale, args.repeat)
+        else:
+            result = run_isolated(name, args.scale, args.repeat)
+        results['cases'][name] = result
+        print('{:<24} {:>10.3f} MB/s {:>12.0f} nodes/s {:>10} KB peak RSS'.format(
+            name, result['mb_per_s'], result['nodes_per_s'],
+            result['peak_rss_kb']
+        ))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            previous = json.load(f)
+        if compare(results, previous, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
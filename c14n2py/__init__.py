@@ -1,10 +1,25 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import hashlib
 import logging
-from enum import Enum
-from collections import defaultdict
-from xml.dom.minidom import Node, Attr
+import mmap
+import multiprocessing
+import re
+import weakref
+from collections import OrderedDict, deque, namedtuple
+from operator import attrgetter
+from xml.dom import XML_NAMESPACE, XMLNS_NAMESPACE, pulldom
+from xml.dom.minidom import Node
+from xml.parsers import expat
+from xml.sax.expatreader import ExpatParser
+from xml.sax.handler import feature_external_ges, feature_namespaces, property_lexical_handler
+from xml.sax.xmlreader import AttributesNSImpl
+from io import BytesIO
 from StringIO import StringIO
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 
 
 logger = logging.getLogger('c14n2py')
@@ -12,6 +27,9 @@ logger = logging.getLogger('c14n2py')
 
 class Attribute(object):
 
+    __slots__ = ('uri', 'localName', 'value', 'attributeQualified', 'attrPrfx',
+                 'oldPrefix', 'sortKey')
+
     def __init__(self):
         self.uri = None  # type: string
         self.localName = None  # type: string
@@ -19,10 +37,13 @@ class Attribute(object):
         self.attributeQualified = True  # type: bool
         self.attrPrfx = None  # type: string
         self.oldPrefix = None  # type: string
+        self.sortKey = None  # type: string
 
 
 class NSDeclaration(object):
 
+    __slots__ = ('uri', 'prefix')
+
     def __init__(self):
         self.uri = None  # type: string
         self.prefix = None  # type: string
@@ -67,12 +88,70 @@ class Parameters(object):
         self.qnameAwareElements = list()  # type: list[QNameAwareParameter]
         self.qnameAwareXPathElements = list()  # type: list[QNameAwareParameter]
 
+    def compile(self):
+        """
+        Creates an immutable snapshot of the parameters which can be shared
+        between canonicalizations and threads
+
+        :return:
+        :rtype: CompiledParameters
+        """
+        qnameAwareElements = frozenset(
+            (en.ns or '', en.name) for en in self.qnameAwareElements)
+        qnameAwareQualifiedAttributes = frozenset(
+            (en.ns or '', en.name) for en in self.qnameAwareQualifiedAttributes)
+        qnameAwareUnqualifiedAttributes = frozenset(
+            (en.ns or '', en.parentName, en.name) for en in self.qnameAwareUnqualifiedAttributes)
+        qnameAwareXPathElements = frozenset(
+            (en.ns or '', en.name) for en in self.qnameAwareXPathElements)
+        qnameAware = bool(qnameAwareElements or qnameAwareQualifiedAttributes or
+                          qnameAwareUnqualifiedAttributes or qnameAwareXPathElements)
+        return CompiledParameters(
+            self.ignoreComments,
+            self.trimTextNodes,
+            self.prefixRewrite,
+            self.prefixRewrite == self.SEQUENTIAL,
+            qnameAware,
+            qnameAwareElements,
+            qnameAwareQualifiedAttributes,
+            qnameAwareUnqualifiedAttributes,
+            qnameAwareXPathElements,
+        )
+
+
+class CompiledParameters(namedtuple('CompiledParameters', [
+        'ignoreComments', 'trimTextNodes', 'prefixRewrite', 'sequential', 'qnameAware',
+        'qnameAwareElements', 'qnameAwareQualifiedAttributes',
+        'qnameAwareUnqualifiedAttributes', 'qnameAwareXPathElements'])):
+    """
+    Immutable form of Parameters created by Parameters.compile(). QName aware
+    lists are stored as frozensets of (uri, localName) tuples, unqualified
+    attributes as (uri, parentName, localName) tuples.
+    """
+
+    __slots__ = ()
+
+    def compile(self):
+        """
+        :return:
+        :rtype: CompiledParameters
+        """
+        return self
+
 
 class PrefixesContainer(object):
+    """
+    Namespace scope stack. Current bindings are kept in prefixMap and every
+    definition is recorded in undoLog together with its level and the binding
+    it replaced, so definition, lookup and level removal are O(1) per binding.
+    Levels are removed in reverse order of their definition.
+    """
+
+    __slots__ = ('prefixMap', 'undoLog')
 
     def __init__(self):
-        self.prefixMap = defaultdict(list)  # type: dict
-        self.prefDefLevel = defaultdict(list)  # type: dict
+        self.prefixMap = dict()  # type: dict
+        self.undoLog = list()  # type: list[tuple]
 
     def definePrefix(self, firstKey, secondKey, level):
         """
@@ -83,10 +162,12 @@ class PrefixesContainer(object):
         :param level:
         :type level: int
         """
-        logger.debug('definePrefix(firstKey={}, secondKey={}, level={}) called'.format(
-            firstKey, secondKey, level))
-        self.prefixMap[firstKey].append(secondKey)
-        self.prefDefLevel[level].append(firstKey)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('definePrefix(firstKey=%s, secondKey=%s, level=%s) called',
+                         firstKey, secondKey, level)
+        prefixMap = self.prefixMap
+        self.undoLog.append((level, firstKey, prefixMap.get(firstKey)))
+        prefixMap[firstKey] = secondKey
 
     def getByFirstKey(self, firstKey):
         """
@@ -95,26 +176,37 @@ class PrefixesContainer(object):
         :return:
         :rtype: string
         """
-        if self.prefixMap.get(firstKey):
-            return self.prefixMap[firstKey][-1]
+        return self.prefixMap.get(firstKey)
 
     def deleteLevel(self, level):
         """
         :param level:
         :type level: int
         """
-        if self.prefDefLevel.get(level):
-            for firstKey in self.prefDefLevel[level]:
-                self.prefixMap[firstKey].pop()
-            del self.prefDefLevel[level][:]
+        undoLog = self.undoLog
+        prefixMap = self.prefixMap
+        while undoLog and undoLog[-1][0] == level:
+            _, firstKey, previous = undoLog.pop()
+            if previous is None:
+                del prefixMap[firstKey]
+            else:
+                prefixMap[firstKey] = previous
+
+    def getBindings(self):
+        """
+        :return: snapshot of the current bindings
+        :rtype: frozenset[tuple]
+        """
+        return frozenset(self.prefixMap.items())
 
     def __str__(self):
-        return "map: {}\ndef level: {}".format(self.prefixMap,
-                                               self.prefDefLevel)
+        return "map: {}\nundo log: {}".format(self.prefixMap, self.undoLog)
 
 
 class QNameAwareParameter(object):
 
+    __slots__ = ('name', 'ns', 'parentName')
+
     def __init__(self, name, ns, parentName=None):
         """
         :param name:
@@ -129,36 +221,87 @@ class QNameAwareParameter(object):
         self.parentName = parentName  # type: string
 
 
-class XPathParserStates(Enum):
-    COMMON = 1
-    SINGLE_QUOTED_STRING = 2
-    DOUBLE_QUOTED_STRING = 3
-    COLON = 4
-    PREFIX = 5
-
-
-def cmp_ns_by_uri(t0, t1):
+class OutputSink(object):
     """
-    :param t0:
-    :type t0: NSDeclaration
-    :param t1:
-    :type t1: NSDeclaration
-    :return:
-    :rtype: int
+    Buffered output which encodes canonical text into UTF-8 chunks and
+    passes them to a target: a file-like object, a socket, a hashlib object,
+    a bytearray or any callable accepting bytes.
     """
-    return cmp(t0.uri, t1.uri)
+
+    BUFFER_SIZE = 64 * 1024  # type: int
+    ENCODING = 'utf-8'  # type: string
+
+    def __init__(self, target, bufferSize=BUFFER_SIZE):
+        """
+        :param target:
+        :type target: file | socket.socket | hashlib.HASH | bytearray | callable
+        :param bufferSize: number of characters collected before a chunk is written
+        :type bufferSize: int
+        """
+        if isinstance(target, bytearray):
+            self.emit = target.extend
+        elif hasattr(target, 'write'):
+            self.emit = target.write
+        elif hasattr(target, 'update'):
+            self.emit = target.update
+        elif hasattr(target, 'sendall'):
+            self.emit = target.sendall
+        elif callable(target):
+            self.emit = target
+        else:
+            raise TypeError('target must be file-like, hash-like or callable!')
+        self.bufferSize = bufferSize  # type: int
+        self.parts = list()  # type: list[string]
+        self.size = 0  # type: int
+
+    def write(self, text):
+        """
+        :param text:
+        :type text: string
+        """
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.bufferSize:
+            self.flush()
+
+    def flush(self):
+        """ Encodes buffered text and writes it to the target """
+        if self.parts:
+            data = ''.join(self.parts).encode(self.ENCODING)
+            del self.parts[:]
+            self.size = 0
+            self.emit(data)
 
 
-def cmp_ns_by_prefix(t0, t1):
+class QNameMatcher(object):
     """
-    :param t0:
-    :type t0: NSDeclaration
-    :param t1:
-    :type t1: NSDeclaration
-    :return:
-    :rtype: int
+    Exclusion predicate which matches elements and attributes by expanded
+    names written as {uri}localName
     """
-    return cmp(t0.prefix, t1.prefix)
+
+    def __init__(self, *names):
+        """
+        :param names:
+        :type names: string
+        """
+        self.names = set()  # type: set[tuple]
+        for name in names:
+            if name.startswith('{'):
+                uri, localName = name[1:].split('}', 1)
+            else:
+                uri, localName = '', name
+            self.names.add((uri, localName))
+
+    def __call__(self, node):
+        """
+        :param node:
+        :type node: xml.dom.minidom.Node
+        :return:
+        :rtype: bool
+        """
+        if node.nodeType != Node.ELEMENT_NODE and node.nodeType != Node.ATTRIBUTE_NODE:
+            return False
+        return (node.namespaceURI or '', node.localName) in self.names
 
 
 class DOMCanonicalizerHandler(object):
@@ -167,63 +310,78 @@ class DOMCanonicalizerHandler(object):
     EMPTY_PREFIX = ""  # type: string
     XMLNS = "xmlns"  # type: string
     XML = "xml"  # type: string
-    CF = "&#x%s;"  # type: string
     C = ":"  # type: string
-    ID_ARRAY_CAPACITY = 20  # type: int
-    PREFIX_ARRAY_CAPACITY = 10  # type: int
     PVDNP_MODE = True  # type: bool
-
-    def __init__(self, node, parameters, excludeList, outputBuffer):
-        """
-        :param node:
+    ESCAPES = {
+        '&': '&amp;',
+        '<': '&lt;',
+        '>': '&gt;',
+        '"': '&quot;',
+        '#xA': '&#xA;',
+        '#x9': '&#x9;',
+        '#xD': '&#xD;',
+        '\t': '&#x9;',
+        '\n': '&#xA;',
+        '\r': '&#xD;',
+    }  # type: dict
+    ATTR_ESCAPE = re.compile(u'[&<>\t\n\r]|#xD')  # type: re.RegexObject
+    TEXT_ESCAPE = re.compile(u'[&<"\r]|#x[A9D]')  # type: re.RegexObject
+    CDATA_ESCAPE = re.compile(u'[&<"]|#x[A9D]')  # type: re.RegexObject
+    # string literal or NCName followed by a single colon (not an axis separator)
+    XPATH_PREFIX = re.compile(u'"[^"]*(?:"|$)|\'[^\']*(?:\'|$)|(?<![\\w.-])([\\w.-]+)(?=:(?!:))',
+                              re.UNICODE)  # type: re.RegexObject
+
+    def __init__(self, node, parameters, excludeList, outputBuffer, parentNamespaces=None):
+        """
+        :param node: canonicalized node or None if there is no tree (streaming mode)
         :type node: xml.dom.minidom.Node
         :param parameters:
-        :type parameters: Parameters
-        :param excludeList:
-        :type excludeList: list[xml.dom.minidom.Node]
+        :type parameters: Parameters | CompiledParameters
+        :param excludeList: excluded nodes or predicate (e.g. QNameMatcher)
+        :type excludeList: set[xml.dom.minidom.Node] | callable
         :param outputBuffer:
-        :type outputBuffer: StringIO.StringIO
-        """
-        self.excludeList = excludeList  # type: list[xml.dom.minidom.Node]
-        self.parameters = parameters  # type: Parameters
-        self.outputBuffer = outputBuffer  # type: StringIO.StringIO
+        :type outputBuffer: StringIO.StringIO | OutputSink
+        :param parentNamespaces: precomputed prefix -> uri bindings declared by
+            ancestors of node, they are collected from the tree if None
+        :type parentNamespaces: dict
+        """
+        if excludeList is None or callable(excludeList):
+            self.excludeList = None  # type: set[xml.dom.minidom.Node]
+            self.excludeFilter = excludeList  # type: callable
+        else:
+            if not isinstance(excludeList, (set, frozenset)):
+                excludeList = set(excludeList)
+            self.excludeList = excludeList  # type: set[xml.dom.minidom.Node]
+            self.excludeFilter = None  # type: callable
+        self.parameters = parameters.compile()  # type: CompiledParameters
+        self.outputBuffer = outputBuffer  # type: StringIO.StringIO | OutputSink
         self.nextId = 0  # type: int
         self.redefinedPrefixesMap = dict()  # type: dict
         self.nodeDepth = 0  # type: int
         self.declaredPrefixes = PrefixesContainer()  # type: PrefixesContainer
         self.usedPrefixes = PrefixesContainer()  # type: PrefixesContainer
-        self.qNameAwareElements = set()  # type: set
-        self.qNameAwareQualifiedAttrs = set()  # type: set
-        self.qNameAwareXPathElements = set()  # type: set
-        self.qNameAwareUnqualifiedAttrs = set()  # type: set
-        self.bSequential = parameters.prefixRewrite == Parameters.SEQUENTIAL  # type: Parameters
-        self.tempXpathStorage = None  # type: list
-        self.tempPrefixStorage = None  # type: list
-
-        self.loadParentNamespaces(node)
+        self.qNameAware = self.parameters.qnameAware  # type: bool
+        self.qNameAwareElements = self.parameters.qnameAwareElements  # type: frozenset
+        self.qNameAwareQualifiedAttrs = self.parameters.qnameAwareQualifiedAttributes  # type: frozenset
+        self.qNameAwareXPathElements = self.parameters.qnameAwareXPathElements  # type: frozenset
+        self.qNameAwareUnqualifiedAttrs = self.parameters.qnameAwareUnqualifiedAttributes  # type: frozenset
+        self.bSequential = self.parameters.sequential  # type: bool
+        self.xpathPrefixes = dict()  # type: dict
+        self.names = dict()  # type: dict
+        # (end tag, QName aware text, QName aware XPath) of open elements
+        self.frames = list()  # type: list[tuple]
+        # xml:space="preserve" flags of open elements, tracked for trimTextNodes only
+        self.preserveSpace = None  # type: list[bool]
+        if self.parameters.trimTextNodes:
+            self.preserveSpace = [self.loadParentSpace(node)]
+
+        if parentNamespaces is None:
+            self.loadParentNamespaces(node)
+        else:
+            self.defineParentNamespaces(parentNamespaces)
         if self.declaredPrefixes.getByFirstKey("") is None:
             self.declaredPrefixes.definePrefix("", "", 0)
 
-        self.initQNameAwareElements()
-        self.initQNameAwareQualifiedAttrs()
-        self.initQNameAwareXPathElements()
-        self.initQNameAwareUnqualifiedAttrs()
-
-    def initQNameAwareUnqualifiedAttrs(self):
-        for en in self.parameters.qnameAwareUnqualifiedAttributes:
-            qNameAwareElement = self.createQName(en.ns, en.parentName, en.name)
-            self.qNameAwareUnqualifiedAttrs.add(qNameAwareElement)
-
-    def initQNameAwareQualifiedAttrs(self):
-        for en in self.parameters.qnameAwareQualifiedAttributes:
-            qNameAwareElement = self.createQName(en.ns, en.name)
-            self.qNameAwareQualifiedAttrs.add(qNameAwareElement)
-
-    def initQNameAwareXPathElements(self):
-        for en in self.parameters.qnameAwareXPathElements:
-            qNameAwareElement = self.createQName(en.ns, en.name)
-            self.qNameAwareXPathElements.add(qNameAwareElement)
-
     def createQName(self, uri, localName, attrName=None):
         """
         :param uri:
@@ -244,11 +402,6 @@ class DOMCanonicalizerHandler(object):
             sb += attrName
         return sb
 
-    def initQNameAwareElements(self):
-        for en in self.parameters.qnameAwareElements:
-            qNameAwareElement = self.createQName(en.ns, en.name)
-            self.qNameAwareElements.add(qNameAwareElement)
-
     def processElement(self, node):
         """
         :param node:
@@ -257,13 +410,18 @@ class DOMCanonicalizerHandler(object):
         if self.isInExcludeList(node):
             return
         self.nodeDepth += 1
-        self.addNamespaces(node)
+        declarations, attributes = self.collectAttributes(node)
+        self.addNamespaces(node, declarations)
+        if self.preserveSpace is not None:
+            self.enterSpaceScope(attributes)
+        nodePrefix, nodeLocalName = self.splitName(node)
+        nodeUri = self.getNamespaceURIByPrefix(nodePrefix)
         nsDeclarations = set()
-        self.evaluateUriVisibility(node, nsDeclarations)
+        self.evaluateUriVisibility(node, nsDeclarations, nodePrefix, nodeLocalName, nodeUri, attributes)
         nsDeclarationList = list()
         nsDeclarationList.extend(nsDeclarations)
         if self.bSequential:
-            nsDeclarationList.sort(cmp=cmp_ns_by_uri)
+            nsDeclarationList.sort(key=attrgetter('uri'))
             for nsDeclaration in nsDeclarationList:
                 uri = nsDeclaration.uri
                 if uri in self.redefinedPrefixesMap:
@@ -276,17 +434,20 @@ class DOMCanonicalizerHandler(object):
                     nsDeclaration.prefix = newPrefix
                     self.redefinedPrefixesMap[uri] = newPrefix
                 self.usedPrefixes.definePrefix(nsDeclaration.uri, newPrefix, self.nodeDepth)
-        nodeLocalName = self.getLocalName(node)
-        nodePrefix = self.getNodePrefix(node)
-        nodeUri = self.getNamespaceURIByPrefix(nodePrefix)
         newPrefix = self.getNewPrefix(nodeUri, nodePrefix)
         if newPrefix is None or newPrefix == '':
-            self.outputBuffer.write('<%s' % self.getLocalName(node))
+            tagName = nodeLocalName
         else:
-            self.outputBuffer.write('<%s:%s' % (newPrefix, self.getLocalName(node)))
+            tagName = '%s:%s' % (newPrefix, nodeLocalName)
+        self.outputBuffer.write('<' + tagName)
+        if self.qNameAware:
+            qNameText, xPathText = self.getQNameFlags(nodeUri, nodeLocalName)
+            self.frames.append(('</%s>' % tagName, qNameText, xPathText))
+        else:
+            self.frames.append(('</%s>' % tagName, False, False))
 
         if not self.PVDNP_MODE or not self.bSequential:
-            nsDeclarationList.sort(cmp=cmp_ns_by_prefix)
+            nsDeclarationList.sort(key=attrgetter('prefix'))
 
         for nsDeclaration in nsDeclarationList:
             nsName = nsDeclaration.prefix
@@ -296,19 +457,19 @@ class DOMCanonicalizerHandler(object):
             else:
                 self.outputBuffer.write(' %s="%s"' % (self.XMLNS, nsUri))
 
-        outAttrsList = self.processAttributes(node, nodeUri)
+        outAttrsList = self.processAttributes(attributes, nodeUri)
 
         for attribute in outAttrsList:
             attrPrfx = attribute.attrPrfx
             attrName = attribute.localName
             attrValue = attribute.value
-            if attribute.attributeQualified:
-                attrQName = self.createQName(attribute.uri, attribute.localName)
-                if attrQName in self.qNameAwareQualifiedAttrs:
+            if not self.qNameAware:
+                pass
+            elif attribute.attributeQualified:
+                if (attribute.uri or '', attribute.localName) in self.qNameAwareQualifiedAttrs:
                     attrValue = self.processQNameText(attrValue)
             else:
-                attrQName = self.createQName(nodeUri, nodeLocalName, attribute.localName)
-                if attrQName in self.qNameAwareUnqualifiedAttrs:
+                if (nodeUri, nodeLocalName, attribute.localName) in self.qNameAwareUnqualifiedAttrs:
                     attrValue = self.processQNameText(attrValue)
 
             if self.XML == attribute.oldPrefix:
@@ -359,61 +520,64 @@ class DOMCanonicalizerHandler(object):
         """
         uri = self.declaredPrefixes.getByFirstKey(prefix)
         if uri is None:
-            logger.debug('getNamespaceURIByPrefix({}) uri is None. prefixes: {}'.format(
-                prefix, self.declaredPrefixes))
+            logger.debug('getNamespaceURIByPrefix(%s) uri is None. prefixes: %s',
+                         prefix, self.declaredPrefixes)
             raise Exception('uri must not be NoneType!')
         return uri
 
-    def cmp_attrs(self, t0, t1):
-        """
-        :param t0:
-        :type t0: Attribute
-        :param t1:
-        :type t1: Attribute
-        :return:
-        :rtype: int
+    def collectAttributes(self, node):
         """
-        t0Uri = t0.uri if t0.attributeQualified else " "
-        t1Uri = t1.uri if t1.attributeQualified else " "
-        q0 = self.createQName(t0Uri, t0.localName)
-        q1 = self.createQName(t1Uri, t1.localName)
-        return cmp(q0, q1)
+        Fetches and classifies attributes of the element in one pass, the
+        records are reused by all later stages of processElement
 
-    def processAttributes(self, node, nodeUri):
-        """
         :param node:
         :type node: xml.dom.minidom.Node
+        :return: namespace declarations as (prefix, uri) tuples and other
+            attributes as (prefix, localName, escaped value) tuples
+        :rtype: tuple
+        """
+        declarations = list()
+        attributes = list()
+        checkExclusion = self.excludeList is not None or self.excludeFilter is not None
+        for attr in node.attributes.values():
+            if checkExclusion and self.isInExcludeList(attr):
+                continue
+            prfx, localName = self.splitName(attr)
+            if self.XMLNS == prfx:
+                declarations.append((localName, attr.nodeValue or ''))
+            else:
+                attributes.append((prfx, localName, self.getAttributeValue(attr.nodeValue)))
+        return declarations, attributes
+
+    def processAttributes(self, attributes, nodeUri):
+        """
+        :param attributes: records created by collectAttributes
+        :type attributes: list[tuple]
         :param nodeUri:
         :type nodeUri: string
         :return:
         :rtype: list[Attribute]
         """
         attributeList = list()
-        for ai in range(len(node.attributes)):
-            attr = node.attributes.item(ai)
-            suffix = self.getLocalName(attr)
-            prfxNs = self.getNodePrefix(attr)
-            if self.XMLNS == prfxNs:
-                continue
+        for prfxNs, suffix, value in attributes:
             attribute = Attribute()
             attribute.oldPrefix = prfxNs
-            attribute.localName = self.getLocalName(attr)
+            attribute.localName = suffix
             if self.EMPTY_PREFIX == prfxNs:
                 attribute.uri = nodeUri
                 attribute.attributeQualified = False
-            else:
-                if self.XML != prfxNs:
-                    attribute.uri = self.getNamespaceURIByPrefix(prfxNs)
-                else:
-                    attribute.localName = suffix
-            attribute.value = self.getAttributeValue(attr.nodeValue)
+            elif self.XML != prfxNs:
+                attribute.uri = self.getNamespaceURIByPrefix(prfxNs)
+            attribute.value = value
             if attribute.attributeQualified:
                 newPrefix = self.getNewPrefix(attribute.uri, attribute.oldPrefix)
+                attribute.sortKey = self.createQName(attribute.uri, suffix)
             else:
                 newPrefix = ""
+                attribute.sortKey = self.createQName(" ", suffix)
             attribute.attrPrfx = newPrefix
             attributeList.append(attribute)
-        attributeList.sort(cmp=self.cmp_attrs)
+        attributeList.sort(key=attrgetter('sortKey'))
         return attributeList
 
     def getAttributeValue(self, input):
@@ -424,15 +588,7 @@ class DOMCanonicalizerHandler(object):
         :rtype: string
         """
         attrValue = input if input is not None else ""
-        attrValue = self.processTextbAttr(attrValue, True)
-        value = ''
-        for c in attrValue:
-            codepoint = ord(c)
-            if codepoint == 9 or codepoint == 10 or codepoint == 13:
-                value += self.CF % '{:x}'.format(codepoint).upper()
-            else:
-                value += c
-        return value
+        return self.escape(attrValue, self.ATTR_ESCAPE)
 
     def processEndElement(self, node):
         """
@@ -441,14 +597,10 @@ class DOMCanonicalizerHandler(object):
         """
         if self.isInExcludeList(node):
             return
-        nodePrefix = self.getNodePrefix(node)
-        nodeUri = self.getNamespaceURIByPrefix(nodePrefix)
-        elementPrefix = self.getNewPrefix(nodeUri, nodePrefix)
-        if elementPrefix is None or elementPrefix == '':
-            self.outputBuffer.write('</%s>' % self.getLocalName(node))
-        else:
-            self.outputBuffer.write('</%s:%s>' % (elementPrefix, self.getLocalName(node)))
+        self.outputBuffer.write(self.frames.pop()[0])
         self.removeNamespaces(node)
+        if self.preserveSpace is not None:
+            self.preserveSpace.pop()
         self.nodeDepth -= 1
 
     def processText(self, node):
@@ -457,78 +609,52 @@ class DOMCanonicalizerHandler(object):
         :type node: xml.dom.minidom.Node
         """
         text = node.nodeValue if node.nodeValue != None else ""
-        text = self.processTextbAttr(text, False)
-        value = ''
-        for c in text:
-            codepoint = ord(c)
-            if codepoint == 13:
-                value += self.CF % '{:x}'.format(codepoint).upper()
+        qNameText = False
+        if self.qNameAware:
+            if self.frames:
+                _, qNameText, xPathText = self.frames[-1]
             else:
-                value += c
-        text = value
-        if self.parameters.trimTextNodes:
-            b = True
-            attrs = node.parentNode.attributes
-            for ai in range(len(attrs)):
-                attr = attrs.item(ai)
-                if self.isInExcludeList(attr):
-                    continue
-                if (self.XML == self.getNodePrefix(attr) and
-                        "preserve" == attr.nodeValue and
-                        self.getLocalName(attr) == "space"):
-                    logger.debug('This node contains preserve space directive')
-                    b = False
-                    break
-            if b:
-                text = text.strip()
-        element = node.parentNode if node.nodeType == Node.TEXT_NODE else node
-        nodePrefix = self.getNodePrefix(element)
-        nodeLocalName = self.getLocalName(element)
-        nodeUri = self.getNamespaceURIByPrefix(nodePrefix)
-        nodeQName = self.createQName(nodeUri, nodeLocalName)
-        if nodeQName in self.qNameAwareElements:
+                nodePrefix, nodeLocalName = self.splitName(node.parentNode)
+                qNameText, xPathText = self.getQNameFlags(
+                    self.getNamespaceURIByPrefix(nodePrefix), nodeLocalName)
+            if xPathText:
+                text = self.processXPathText(text)
+        text = self.escape(text, self.TEXT_ESCAPE)
+        if self.preserveSpace is not None and not self.preserveSpace[-1]:
+            text = text.strip()
+        if qNameText:
             text = self.processQNameText(text)
-        if nodeQName in self.qNameAwareXPathElements:
-            text = self.processXPathText(text)
         self.outputBuffer.write(text)
 
-    def writeNewXPathCharacter(self, ch, pos):
+    def getQNameFlags(self, nodeUri, nodeLocalName):
         """
-        :param ch:
-        :type ch: int
-        :param pos:
-        :type pos: int
-        :return:
-        :rtype: int
-        """
-        pos -= 1
-        if pos < 0:
-            # создать новый список заполенный нулями в количестве PREFIX_ARRAY_CAPACITY * 2
-            newResultArr = [0 for i in range(self.PREFIX_ARRAY_CAPACITY * 2)]
-            # скопировать все элементы из self.tempXpathStorage в новый список в позицию PREFIX_ARRAY_CAPACITY * 2
-            newResultArr.extend(self.tempXpathStorage)
-            self.tempXpathStorage = newResultArr
-            pos += self.PREFIX_ARRAY_CAPACITY * 2
-        self.tempXpathStorage[pos] = chr(ch)
-        return pos
-
-    def writeXPathPrefix(self, ch, pos):
-        """
-        :param ch:
-        :type ch: int
-        :param pos:
-        :type pos: int
-        :return:
-        :rtype: int
+        :param nodeUri:
+        :type nodeUri: string
+        :param nodeLocalName:
+        :type nodeLocalName: string
+        :return: whether text of the element is a QName and whether it is an XPath
+        :rtype: tuple
+        """
+        nodeQName = (nodeUri, nodeLocalName)
+        return nodeQName in self.qNameAwareElements, nodeQName in self.qNameAwareXPathElements
+
+    def parseXPathPrefixes(self, text):
+        """
+        Scans XPath expression forward skipping string literals and axis
+        separators. Results are cached, so the visibility and the rewrite
+        passes scan every expression once
+
+        :param text:
+        :type text: string
+        :return: (start, end) positions of namespace prefixes
+        :rtype: tuple
         """
-        pos -= 1
-        if pos < 0:
-            newResultArr = [0 for i in range(self.PREFIX_ARRAY_CAPACITY)]
-            newResultArr.extend(self.tempPrefixStorage)
-            self.tempPrefixStorage = newResultArr
-            pos += self.PREFIX_ARRAY_CAPACITY
-        self.tempPrefixStorage[pos] = chr(ch)
-        return pos
+        spans = self.xpathPrefixes.get(text)
+        if spans is None:
+            spans = tuple(m.span(1) for m in self.XPATH_PREFIX.finditer(text)
+                          if m.group(1) is not None)
+            self.xpathPrefixes[text] = spans
+        return spans
 
     def processXPathText(self, text):
         """
@@ -537,63 +663,17 @@ class DOMCanonicalizerHandler(object):
         :return:
         :rtype: string
         """
-        self.tempXpathStorage = list()
-        resultPos = len(text)
-        self.tempPrefixStorage = list()
-        prefixPos = self.PREFIX_ARRAY_CAPACITY
-        state = XPathParserStates.COMMON
-        for i in reversed(range(len(text))):
-            ch = ord(text[i])
-            if state == XPathParserStates.COMMON:
-                if ch == ord('\''):
-                    state = XPathParserStates.SINGLE_QUOTED_STRING
-                elif ch == ord('"'):
-                    state = XPathParserStates.DOUBLE_QUOTED_STRING
-                elif ch == ord(':'):
-                    state = XPathParserStates.COLON
-                resultPos = self.writeNewXPathCharacter(ch, resultPos)
-
-            elif state == XPathParserStates.SINGLE_QUOTED_STRING:
-                if ch == ord('\''):
-                    state = XPathParserStates.COMMON
-                resultPos = self.writeNewXPathCharacter(ch, resultPos)
-
-            elif state == XPathParserStates.DOUBLE_QUOTED_STRING:
-                if ch == ord('"'):
-                    state = XPathParserStates.COMMON
-                resultPos = self.writeNewXPathCharacter(ch, resultPos)
-
-            elif state == XPathParserStates.COLON:
-                if ch == ord(':'):
-                    state = XPathParserStates.COMMON
-                    resultPos = self.writeNewXPathCharacter(ch, resultPos)
-                    continue
-                if self.isNCSymbol(ch):
-                    state = XPathParserStates.PREFIX
-                    prefixPos = self.writeXPathPrefix(ch, prefixPos)
-
-            elif state == XPathParserStates.PREFIX:
-                if self.isNCSymbol(ch):
-                    prefixPos = self.writeXPathPrefix(ch, prefixPos)
-                else:
-                    prefix = ''.join(self.tempPrefixStorage[prefixPos:])
-                    prefixPos = len(self.tempPrefixStorage)
-                    uri = self.getNamespaceURIByPrefix(prefix)
-                    newPrefix = self.getNewPrefix(uri, prefix)
-                    for j in reversed(range(len(newPrefix))):
-                        newPrefixCh = ord(newPrefix[j])
-                        resultPos = self.writeNewXPathCharacter(newPrefixCh, resultPos)
-                    if ch == '\'':
-                        state = XPathParserStates.SINGLE_QUOTED_STRING
-                    elif ch == '"':
-                        state = XPathParserStates.DOUBLE_QUOTED_STRING
-                    elif ch == ':':
-                        state = XPathParserStates.COLON
-                    else:
-                        state = XPathParserStates.COMMON
-                    resultPos = self.writeNewXPathCharacter(ch, resultPos)
-        result = ''.join(self.tempXpathStorage[resultPos:])
-        return result
+        parts = list()
+        pos = 0
+        for start, end in self.parseXPathPrefixes(text):
+            prefix = text[start:end]
+            parts.append(text[pos:start])
+            parts.append(self.getNewPrefix(self.getNamespaceURIByPrefix(prefix), prefix))
+            pos = end
+        if not parts:
+            return text
+        parts.append(text[pos:])
+        return ''.join(parts)
 
     def processPI(self, node):
         """
@@ -614,12 +694,12 @@ class DOMCanonicalizerHandler(object):
         :param node:
         :type node: xml.dom.minidom.Node
         """
-        self.outputBuffer.write(self.processTextbAttr(node.nodeValue, False))
+        self.outputBuffer.write(self.escape(node.nodeValue, self.CDATA_ESCAPE))
 
     def getOutputBlock(self):
         """
         :return:
-        :rtype: StringIO.StringIO
+        :rtype: StringIO.StringIO | OutputSink
         """
         return self.outputBuffer
 
@@ -630,13 +710,45 @@ class DOMCanonicalizerHandler(object):
         :return:
         :rtype: bool
         """
-        if self.excludeList is not None \
-                and node in self.excludeList \
-                and (node.nodeType == Node.ELEMENT_NODE or isinstance(node, Attr)) \
-                and not (isinstance(node, Attr) and (self.XMLNS == self.getNodePrefix(node) or self.XML == self.getNodePrefix(node))):
+        if self.excludeList is not None:
+            if node not in self.excludeList:
+                return False
+        elif self.excludeFilter is None or not self.excludeFilter(node):
+            return False
+        if node.nodeType == Node.ELEMENT_NODE:
             return True
+        return node.nodeType == Node.ATTRIBUTE_NODE \
+            and self.splitName(node)[0] not in (self.XMLNS, self.XML)
+
+    def loadParentSpace(self, node):
+        """
+        :param node:
+        :type node: xml.dom.minidom.Node
+        :return: True if an ancestor of node sets xml:space to "preserve"
+        :rtype: bool
+        """
+        current = None if node is None else node.parentNode
+        while current is not None and current.nodeType == Node.ELEMENT_NODE:
+            for attr in current.attributes.values():
+                if (self.XML, "space") == self.splitName(attr):
+                    return "preserve" == attr.nodeValue
+            current = current.parentNode
         return False
 
+    def enterSpaceScope(self, attributes):
+        """
+        Pushes xml:space scope of the element, it is inherited unless the
+        element has own xml:space attribute
+
+        :param attributes: records created by collectAttributes
+        :type attributes: list[tuple]
+        """
+        preserve = self.preserveSpace[-1]
+        for prfx, localName, value in attributes:
+            if self.XML == prfx and "space" == localName:
+                preserve = "preserve" == value
+        self.preserveSpace.append(preserve)
+
     def removeNamespaces(self, node):
         """
         :param node:
@@ -645,118 +757,63 @@ class DOMCanonicalizerHandler(object):
         self.usedPrefixes.deleteLevel(self.nodeDepth)
         self.declaredPrefixes.deleteLevel(self.nodeDepth)
 
-    def evaluateUriVisibility(self, node, nsDeclarations):
+    def evaluateUriVisibility(self, node, nsDeclarations, nodePrf, nodeLocalName, nodeUri, attributes):
         """
         :param node:
         :type node: xml.dom.minidom.Node
         :param nsDeclarations:
         :type nsDeclarations: set[NSDeclaration]
+        :param nodePrf:
+        :type nodePrf: string
+        :param nodeLocalName:
+        :type nodeLocalName: string
+        :param nodeUri:
+        :type nodeUri: string
+        :param attributes: records created by collectAttributes
+        :type attributes: list[tuple]
         """
-        nodePrf = self.getNodePrefix(node)
-        nodeLocalName = self.getLocalName(node)
-        nodeUri = self.getNamespaceURIByPrefix(nodePrf)
         self.addNSDeclarationForPrefix(nodePrf, nsDeclarations)
-        for ai in range(len(node.attributes)):
-            attr = node.attributes.item(ai)
-            if self.isInExcludeList(attr):
+        for prfx, attrLocalName, text in attributes:
+            if self.XML == prfx:
                 continue
-            prfx = self.getNodePrefix(attr)
-            if self.XMLNS != prfx:
-                if self.XML == prfx:
-                    continue
-                text = self.getAttributeValue(attr.nodeValue)
+            if self.qNameAware:
                 if self.EMPTY_PREFIX == prfx:
-                    attrNamespaceURI = nodeUri
-                    qName = self.createQName(attrNamespaceURI, nodeLocalName, self.getLocalName(attr))
+                    qName = (nodeUri, nodeLocalName, attrLocalName)
                     self.addVisibilityIfNessesaryByText(qName, text, nsDeclarations, self.qNameAwareUnqualifiedAttrs)
                 else:
                     attrNamespaceURI = self.getNamespaceURIByPrefix(prfx)
-                    qName = self.createQName(attrNamespaceURI, self.getLocalName(attr))
+                    qName = (attrNamespaceURI, attrLocalName)
                     self.addVisibilityIfNessesaryByText(qName, text, nsDeclarations, self.qNameAwareQualifiedAttrs)
-                if prfx != '':
-                    self.addNSDeclarationForPrefix(prfx, nsDeclarations)
-        text = node.nodeValue
-        qName = self.createQName(nodeUri, nodeLocalName)
-        self.addVisibilityIfNessesaryByText(qName, text, nsDeclarations, self.qNameAwareElements)
-        self.addXPathVisibilityIfNessesaryByText(qName, text, nsDeclarations)
+            if prfx != '':
+                self.addNSDeclarationForPrefix(prfx, nsDeclarations)
+        if self.qNameAware:
+            qName = (nodeUri, nodeLocalName)
+            if qName in self.qNameAwareElements or qName in self.qNameAwareXPathElements:
+                text = self.getElementText(node)
+                self.addVisibilityIfNessesaryByText(qName, text, nsDeclarations, self.qNameAwareElements)
+                self.addXPathVisibilityIfNessesaryByText(qName, text, nsDeclarations)
 
-    def isNCSymbol(self, ch):
+    def getElementText(self, node):
         """
-        :param ch:
-        :type ch: int
-        :return:
-        :rtype: bool
+        :param node:
+        :type node: xml.dom.minidom.Node
+        :return: concatenated text and CDATA children of the element
+        :rtype: string
         """
-        s = chr(ch)
-        return s.isalnum() or s == '_' or s == '-' or s == '.'
+        return ''.join(child.nodeValue for child in node.childNodes
+                       if child.nodeType in (Node.TEXT_NODE, Node.CDATA_SECTION_NODE))
 
     def addXPathVisibilityIfNessesaryByText(self, qName, text, nsDeclarations):
         """
         :param qName:
-        :type qName: string
+        :type qName: tuple
         :param text:
         :type text: string
         :param nsDeclarations:
         :type nsDeclarations: set[NSDeclaration]
         """
         if qName in self.qNameAwareXPathElements:
-            xPathPrefixes = set()
-            state = XPathParserStates.COMMON
-            prefixArr = list()
-            pos = self.PREFIX_ARRAY_CAPACITY
-            for i in reversed(range(len(text))):
-                ch = ord(text[i])
-                if state == XPathParserStates.COMMON:
-                    if ch == ord('\''):
-                        state = XPathParserStates.SINGLE_QUOTED_STRING
-                    elif ch == ord('"'):
-                        state = XPathParserStates.DOUBLE_QUOTED_STRING
-                    if ch == ord(':'):
-                        state = XPathParserStates.COLON
-                elif state == XPathParserStates.SINGLE_QUOTED_STRING:
-                    if ch == ord('\''):
-                        state = XPathParserStates.COMMON
-                elif state == XPathParserStates.DOUBLE_QUOTED_STRING:
-                    if ch == ord('"'):
-                        state = XPathParserStates.COMMON
-                elif state == XPathParserStates.COLON:
-                    if ch == ord(':'):
-                        state = XPathParserStates.COMMON
-                        continue
-                    if self.isNCSymbol(ch):
-                        state = XPathParserStates.PREFIX
-                        pos -= 1
-                        if pos < 0:
-                            newPrefixArr = [0 for i in range(self.PREFIX_ARRAY_CAPACITY)]
-                            newPrefixArr.extend(prefixArr)
-                            prefixArr = newPrefixArr
-                            pos += self.PREFIX_ARRAY_CAPACITY
-                        prefixArr[pos] = chr(ch)
-                elif state == XPathParserStates.PREFIX:
-                    if self.isNCSymbol(ch):
-                        pos -= 1
-                        if pos < 0:
-                            newPrefixArr = [0 for i in range(self.PREFIX_ARRAY_CAPACITY)]
-                            newPrefixArr.extend(prefixArr)
-                            prefixArr = newPrefixArr
-                            pos += self.PREFIX_ARRAY_CAPACITY
-                        prefixArr[pos] = chr(ch)
-
-                    else:
-                        prefix = prefixArr[pos:len(prefixArr)]
-                        pos = len(prefixArr)
-                        xPathPrefixes.add(prefix)
-                        if ch == ord('\''):
-                            state = XPathParserStates.SINGLE_QUOTED_STRING
-                            continue
-                        if ch == ord('"'):
-                            state = XPathParserStates.DOUBLE_QUOTED_STRING
-                            continue
-                        if ch == ord(':'):
-                            state = XPathParserStates.COLON
-                            continue
-                        state = XPathParserStates.COMMON
-            for prefix in xPathPrefixes:
+            for prefix in set(text[start:end] for start, end in self.parseXPathPrefixes(text)):
                 self.addNSDeclarationForPrefix(prefix, nsDeclarations)
 
     def addNSDeclarationForPrefix(self, prefix, nsDeclarations):
@@ -787,13 +844,13 @@ class DOMCanonicalizerHandler(object):
     def addVisibilityIfNessesaryByText(self, checkStr, text, nsDeclarations, checkSet):
         """
         :param checkStr:
-        :type checkStr: string
+        :type checkStr: tuple
         :param text:
         :type text: string
         :param nsDeclarations:
         :type nsDeclarations: set[NSDeclaration]
         :param checkSet:
-        :type checkSet: set[string]
+        :type checkSet: frozenset[tuple]
         """
         if checkStr in checkSet:
             prefix = self.getTextPrefix(text)
@@ -815,48 +872,71 @@ class DOMCanonicalizerHandler(object):
             prefix = text[:idx]
         return prefix
 
-    def addNamespaces(self, node):
+    def addNamespaces(self, node, declarations):
         """
         :param node:
         :type node: xml.dom.minidom.Node
-        """
-        for ni in range(len(node.attributes)):
-            attr = node.attributes.item(ni)
-            if self.isInExcludeList(attr):
-                continue
-            suffix = self.getLocalName(attr)
-            prfxNs = self.getNodePrefix(attr)
-            if self.XMLNS == prfxNs:
-                uri = attr.nodeValue or ''
-                logger.debug('New attrib ns found. uri: %r for attrib %r at depth: %r', uri,
-                             suffix, self.nodeDepth)
-                self.declaredPrefixes.definePrefix(suffix, uri, self.nodeDepth)
-        prfxEl = self.getNodePrefix(node)
+        :param declarations: (prefix, uri) records created by collectAttributes
+        :type declarations: list[tuple]
+        """
+        for suffix, uri in declarations:
+            logger.debug('New attrib ns found. uri: %r for attrib %r at depth: %r', uri,
+                         suffix, self.nodeDepth)
+            self.declaredPrefixes.definePrefix(suffix, uri, self.nodeDepth)
+        prfxEl = self.splitName(node)[0]
         uri = node.namespaceURI or ''
         if prfxEl == '' and uri != '':
             logger.debug('New node ns found. uri: %r for node %r at depth: %r', uri,
                          prfxEl, self.nodeDepth)
             self.declaredPrefixes.definePrefix(prfxEl, uri, self.nodeDepth)
 
-    def processTextbAttr(self, text, bAttr):
+    def escape(self, text, pattern):
         """
+        Replaces all pattern matches in one pass using ESCAPES table
+
         :param text:
         :type text: string
-        :param bAttr:
-        :type bAttr: bool
+        :param pattern: one of *_ESCAPE patterns
+        :type pattern: re.RegexObject
         :return:
         :rtype: string
         """
-        text = text.replace("&", "&amp;")
-        text = text.replace("<", "&lt;")
-        if bAttr:
-            text = text.replace(">", "&gt;")
-        else:
-            text = text.replace("\"", "&quot;")
-            text = text.replace("#xA", "&#xA;")
-            text = text.replace("#x9", "&#x9;")
-        text = text.replace("#xD", "&#xD;")
-        return text
+        if pattern.search(text) is None:
+            return text
+        return pattern.sub(self.replaceEscaped, text)
+
+    def replaceEscaped(self, match):
+        """
+        :param match:
+        :type match: re.MatchObject
+        :return:
+        :rtype: string
+        """
+        return self.ESCAPES[match.group()]
+
+    def splitName(self, node):
+        """
+        Splits qualified name of node into prefix and local name. Results are
+        kept in the names table, so every distinct name is split only once
+
+        :param node:
+        :type node: xml.dom.minidom.Node
+        :return: prefix and local name
+        :rtype: tuple
+        """
+        name = node.nodeName
+        split = self.names.get(name)
+        if split is None:
+            if self.XMLNS == name:
+                split = (name, '')
+            else:
+                idx = name.find(self.C)
+                if idx > -1:
+                    split = (name[:idx], name[idx+1:])
+                else:
+                    split = ('', name)
+            self.names[name] = split
+        return split
 
     def getLocalName(self, node):
         """
@@ -865,13 +945,7 @@ class DOMCanonicalizerHandler(object):
         :return:
         :rtype: string
         """
-        name = node.localName if node.localName is not None else node.nodeName
-        if self.XMLNS == name:
-            return ''
-        idx = name.find(self.C)
-        if idx > -1:
-            return name[idx+1:]
-        return name
+        return self.splitName(node)[1]
 
     def getNodePrefix(self, node):
         """
@@ -880,16 +954,7 @@ class DOMCanonicalizerHandler(object):
         :return:
         :rtype: string
         """
-        prfx = node.prefix
-        if prfx is None or prfx == '':
-            prfx = ''
-            name = node.nodeName
-            if self.XMLNS == name:
-                return name
-            idx = name.find(self.C)
-            if idx > -1:
-                return name[:idx]
-        return prfx
+        return self.splitName(node)[0]
 
     def loadParentNamespaces(self, node):
         """
@@ -898,92 +963,289 @@ class DOMCanonicalizerHandler(object):
         """
         current = node
         parentNodeList = list()
-        while current.parentNode is not None and current.parentNode.nodeType != Node.DOCUMENT_NODE:
+        while current is not None and current.parentNode is not None \
+                and current.parentNode.nodeType != Node.DOCUMENT_NODE:
             current = current.parentNode
             parentNodeList.append(current)
         depth = 0
         for i in reversed(range(len(parentNodeList))):
             depth += 1
             pnode = parentNodeList[i]
-            for ni in range(len(pnode.attributes)):
-                attr = pnode.attributes.item(ni)
-                suffix = self.getLocalName(attr)
-                prfxNs = self.getNodePrefix(attr)
+            for attr in pnode.attributes.values():
+                prfxNs, suffix = self.splitName(attr)
                 if self.XMLNS == prfxNs:
                     uri = attr.nodeValue
                     self.declaredPrefixes.definePrefix(suffix, uri, -depth)
         depth += 1
         self.declaredPrefixes.definePrefix("SOAP-ENV", "http://schemas.xmlsoap.org/soap/envelope/", -depth)
 
+    def defineParentNamespaces(self, parentNamespaces):
+        """
+        Same as loadParentNamespaces for bindings computed in advance
+
+        :param parentNamespaces: prefix -> uri
+        :type parentNamespaces: dict
+        """
+        for prefix, uri in parentNamespaces.items():
+            self.declaredPrefixes.definePrefix(prefix, uri, -1)
+        self.declaredPrefixes.definePrefix("SOAP-ENV", "http://schemas.xmlsoap.org/soap/envelope/", -2)
+
+
+class DefaultCanonicalizerHandler(DOMCanonicalizerHandler):
+    """
+    Handler specialised for parameters without sequential prefix rewriting
+    and QName aware lists. Prefixes are never renamed in this mode, so
+    QName and prefix mapping machinery is skipped completely.
+    """
+
+    def processElement(self, node):
+        """
+        :param node:
+        :type node: xml.dom.minidom.Node
+        """
+        if self.isInExcludeList(node):
+            return
+        self.nodeDepth += 1
+        declarations, records = self.collectAttributes(node)
+        self.addNamespaces(node, declarations)
+        if self.preserveSpace is not None:
+            self.enterSpaceScope(records)
+        nsDeclarations = list()
+        self.addVisiblePrefix(self.getNodePrefix(node), nsDeclarations)
+        attributes = list()
+        for prfx, localName, value in records:
+            if self.EMPTY_PREFIX == prfx:
+                attributes.append(('{ }' + localName, ' %s="%s"' % (localName, value)))
+            elif self.XML == prfx:
+                attributes.append(('{}' + localName, ' %s:%s="%s"' % (prfx, localName, value)))
+            else:
+                self.addVisiblePrefix(prfx, nsDeclarations)
+                uri = self.getNamespaceURIByPrefix(prfx)
+                attributes.append(('{%s}%s' % (uri, localName), ' %s:%s="%s"' % (prfx, localName, value)))
+        nsDeclarations.sort()
+        attributes.sort()
+        parts = ['<', node.nodeName]
+        for prefix, uri in nsDeclarations:
+            if prefix != self.EMPTY_PREFIX:
+                parts.append(' %s:%s="%s"' % (self.XMLNS, prefix, uri))
+            else:
+                parts.append(' %s="%s"' % (self.XMLNS, uri))
+        for key, attribute in attributes:
+            parts.append(attribute)
+        parts.append('>')
+        self.outputBuffer.write(''.join(parts))
+
+    def addVisiblePrefix(self, prefix, nsDeclarations):
+        """
+        Marks prefix as used, adds (prefix, uri) to nsDeclarations if it has
+        to be declared on the current element
+
+        :param prefix:
+        :type prefix: string
+        :param nsDeclarations:
+        :type nsDeclarations: list[tuple]
+        """
+        prefixUri = self.getNamespaceURIByPrefix(prefix)
+        existsUri = self.usedPrefixes.getByFirstKey(prefix)
+        if existsUri is None or existsUri != prefixUri:
+            self.usedPrefixes.definePrefix(prefix, prefixUri, self.nodeDepth)
+            if existsUri is not None or self.EMPTY_PREFIX != prefix or self.EMPTY_URI != prefixUri:
+                nsDeclarations.append((prefix, prefixUri))
+
+    def processEndElement(self, node):
+        """
+        :param node:
+        :type node: xml.dom.minidom.Node
+        """
+        if self.isInExcludeList(node):
+            return
+        self.outputBuffer.write('</%s>' % node.nodeName)
+        self.removeNamespaces(node)
+        if self.preserveSpace is not None:
+            self.preserveSpace.pop()
+        self.nodeDepth -= 1
+
 
-def getNodeDepth(node):
+def createHandler(node, parameters, excludeList, outputBuffer, parentNamespaces=None):
     """
+    Creates the fastest handler suitable for the parameters
+
     :param node:
     :type node: xml.dom.minidom.Node
+    :param parameters:
+    :type parameters: Parameters | CompiledParameters
+    :param excludeList:
+    :type excludeList: set[xml.dom.minidom.Node] | callable
+    :param outputBuffer:
+    :type outputBuffer: StringIO.StringIO | OutputSink
+    :param parentNamespaces:
+    :type parentNamespaces: dict
     :return:
-    :rtype: int
+    :rtype: DOMCanonicalizerHandler
     """
-    i = -1
-    prnt = node
-    while True:
-        i += 1
-        prnt = prnt.parentNode
-        if prnt is None:
-            break
-    return i
+    parameters = parameters.compile()
+    if parameters.sequential or parameters.qnameAware:
+        return DOMCanonicalizerHandler(node, parameters, excludeList, outputBuffer, parentNamespaces)
+    return DefaultCanonicalizerHandler(node, parameters, excludeList, outputBuffer, parentNamespaces)
 
 
-def compare_nodes(n1, n2):
+def getDocumentOrder(node):
+    """
+    Numbers all nodes of the document containing node in document order
+
+    :param node:
+    :type node: xml.dom.minidom.Node
+    :return: node -> position in the pre-order traversal
+    :rtype: dict
     """
-    :param n1:
-    :type n1: xml.dom.minidom.Node
-    :param n2:
-    :type n2: xml.dom.minidom.Node
+    root = node
+    while root.parentNode is not None:
+        root = root.parentNode
+    order = dict()
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        order[current] = len(order)
+        childNodes = current.childNodes
+        if childNodes:
+            stack.extend(reversed(childNodes))
+    return order
+
+
+def getSubtreeHash(node, hashes=None):
+    """
+    Structural digest of the subtree: element names, namespaces, attributes
+    and character data in document order. Comments and processing
+    instructions are skipped as they never reach the output. Digests are
+    computed bottom-up, an element digest covers digests of its children.
+
+    :param node:
+    :type node: xml.dom.minidom.Node
+    :param hashes: element -> digest of already hashed subtrees, filled for
+        every element of the subtree, so nested subtrees are not hashed again
+    :type hashes: dict
     :return:
-    :rtype: int
+    :rtype: bytes
     """
-    l1 = getNodeDepth(n1)
-    l2 = getNodeDepth(n2)
-    if l1 != l2:
-        return l1 - l2
-    else:
-        prnt1 = n1.parentNode
-        prnt2 = n2.parentNode
-        if prnt1 is None:
-            return -1
-        elif prnt2 is None:
-            return 1
-        if prnt1 == prnt2:
-            nl = prnt1.childNodes
-            l1 = -1
-            l2 = -1
-            for i in range(len(nl)):
-                if n1 == nl[i]:
-                    l1 = i
-                elif n2 == nl[i]:
-                    l2 = i
-                if l1 != -1 and l2 != -1:
-                    break
-            return l1 - l2
-        else:
-            return compare_nodes(prnt1, prnt2)
+    if hashes is None:
+        hashes = dict()
+    digest = hashes.get(node)
+    if digest is not None:
+        return digest
+    # (element, children once they are being hashed), children are read
+    # once per element and kept until its digest is computed
+    stack = [(node, None)]
+    while stack:
+        current, childNodes = stack.pop()
+        if childNodes is None:
+            childNodes = current.childNodes
+            stack.append((current, childNodes))
+            for child in childNodes:
+                if child.nodeType == Node.ELEMENT_NODE and child not in hashes:
+                    stack.append((child, None))
+            continue
+        parts = [u'\x01', current.nodeName, u'\x00', current.namespaceURI or u'']
+        for attr in sorted(current.attributes.values(), key=attrgetter('nodeName')):
+            parts.extend((u'\x00', attr.nodeName, u'=', attr.nodeValue or u''))
+        h = hashlib.sha1(u''.join(parts).encode('utf-8'))
+        for child in childNodes:
+            nodeType = child.nodeType
+            if nodeType == Node.ELEMENT_NODE:
+                h.update(b'\x02' + hashes[child])
+            elif nodeType == Node.TEXT_NODE or nodeType == Node.CDATA_SECTION_NODE:
+                h.update((u'\x03%d\x00%s' % (nodeType, child.nodeValue)).encode('utf-8'))
+        hashes[current] = h.digest()
+    return hashes[node]
+
+
+class SubtreeCache(object):
+    """
+    Opt-in LRU cache of canonical forms of subtrees. Elements accepted by
+    match are looked up by the structural digest of the subtree, the in-scope
+    namespace context and the compiled parameters; on a hit the subtree is
+    emitted without being walked. The cache is bypassed for sequential prefix
+    rewriting and include/exclude lists, where the output of a subtree depends
+    on more than its content.
+    """
+
+    MAX_BYTES = 16 * 1024 * 1024  # type: int
+
+    def __init__(self, match, maxBytes=MAX_BYTES):
+        """
+        :param match: predicate selecting cached elements (e.g. QNameMatcher)
+        :type match: callable
+        :param maxBytes: budget for UTF-8 size of cached canonical text
+        :type maxBytes: int
+        """
+        self.match = match  # type: callable
+        self.maxBytes = maxBytes  # type: int
+        self.entries = OrderedDict()  # type: OrderedDict
+        self.size = 0  # type: int
+        self.hits = 0  # type: int
+        self.misses = 0  # type: int
+
+    def get(self, key):
+        """
+        :param key:
+        :type key: tuple
+        :return: canonical text or None
+        :rtype: string
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, text):
+        """
+        :param key:
+        :type key: tuple
+        :param text:
+        :type text: string
+        """
+        size = len(text.encode('utf-8'))
+        if size > self.maxBytes:
+            return
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+        while self.entries and self.size + size > self.maxBytes:
+            self.size -= self.entries.popitem(last=False)[1][1]
+        self.entries[key] = (text, size)
+        self.size += size
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
 
 
 class DOMCanonicalizer(object):
 
-    def __init__(self, node, includeList, excludeList, params):
+    def __init__(self, node, includeList, excludeList, params, outputBuffer=None, cache=None,
+                 parentNamespaces=None):
         """
 
         :param node:
         :type node: xml.dom.minidom.Node
         :param includeList:
         :type includeList: list[xml.dom.minidom.Node]
-        :param excludeList:
-        :type excludeList: list[xml.dom.minidom.Node]
+        :param excludeList: excluded nodes or predicate (e.g. QNameMatcher)
+        :type excludeList: list[xml.dom.minidom.Node] | set[xml.dom.minidom.Node] | callable
         :param params:
-        :type params: Parameters
-        """
-        self.nodes = list()  # type: list[xml.dom.minidom.Node]
+        :type params: Parameters | CompiledParameters
+        :param outputBuffer: output for canonical text, StringIO is used if None
+        :type outputBuffer: OutputSink
+        :param cache:
+        :type cache: SubtreeCache
+        :param parentNamespaces: precomputed namespace bindings of node ancestors
+        :type parentNamespaces: dict
+        """
+        self.nodes = deque()  # type: deque[xml.dom.minidom.Node]
+        self.documentOrder = None  # type: dict
+        self.chunks = None  # type: list[bytes]
         if node is None:
             raise Exception('node must not be Nontype!')
         if includeList is not None and len(includeList) == 0:
@@ -991,62 +1253,1503 @@ class DOMCanonicalizer(object):
         else:
             self.includeList = includeList  # type: list[xml.dom.minidom.Node]
         self.node = node  # type: xml.dom.minidom.Node
-        sb = StringIO()
+        sb = StringIO() if outputBuffer is None else outputBuffer
         parameters = Parameters() if params is None else params
-        excludeList = None if excludeList is not None and len(excludeList) == 0 else excludeList
-        self.canonicalizer = DOMCanonicalizerHandler(node, parameters, excludeList, sb)  # type: DOMCanonicalizerHandler
+        if excludeList is not None and not callable(excludeList) and len(excludeList) == 0:
+            excludeList = None
+        self.canonicalizer = createHandler(node, parameters, excludeList, sb,
+                                           parentNamespaces)  # type: DOMCanonicalizerHandler
+        if self.includeList is not None or excludeList is not None or self.canonicalizer.bSequential:
+            cache = None
+        self.cache = cache  # type: SubtreeCache
+        # digests of elements inside the outermost matched subtree
+        self.subtreeHashes = dict()  # type: dict
+
+    @staticmethod
+    def canonicalize(node, params, includeList=None, excludeList=None, out=None,
+                     bufferSize=OutputSink.BUFFER_SIZE, cache=None):
+        """
+        :param node:
+        :type node: xml.dom.minidom.Node
+        :param params:
+        :type params: Parameters | CompiledParameters
+        :param includeList:
+        :type includeList: list[xml.dom.minidom.Node]
+        :param excludeList: excluded nodes or predicate (e.g. QNameMatcher)
+        :type excludeList: list[xml.dom.minidom.Node] | set[xml.dom.minidom.Node] | callable
+        :param out: target for UTF-8 chunks, see OutputSink
+        :type out: file | socket.socket | hashlib.HASH | bytearray | callable
+        :param bufferSize:
+        :type bufferSize: int
+        :param cache:
+        :type cache: SubtreeCache
+        :return: canonical text or None if out is given
+        :rtype: string
+        """
+        outputBuffer = None if out is None else OutputSink(out, bufferSize)
+        return DOMCanonicalizer(node, includeList, excludeList, params, outputBuffer,
+                                cache).canonicalizeSubTree()
+
+    @staticmethod
+    def digest(node, params, algorithm='sha256', includeList=None, excludeList=None,
+               bufferSize=OutputSink.BUFFER_SIZE, cache=None):
+        """
+        Calculates digest of the canonical form without building the output string
+
+        :param node:
+        :type node: xml.dom.minidom.Node
+        :param params:
+        :type params: Parameters | CompiledParameters
+        :param algorithm: any name accepted by hashlib.new
+        :type algorithm: string
+        :param includeList:
+        :type includeList: list[xml.dom.minidom.Node]
+        :param excludeList: excluded nodes or predicate (e.g. QNameMatcher)
+        :type excludeList: list[xml.dom.minidom.Node] | set[xml.dom.minidom.Node] | callable
+        :param bufferSize:
+        :type bufferSize: int
+        :param cache:
+        :type cache: SubtreeCache
+        :return: raw digest value
+        :rtype: bytes
+        """
+        h = hashlib.new(algorithm)
+        DOMCanonicalizer.canonicalize(node, params, includeList, excludeList, h, bufferSize, cache)
+        return h.digest()
+
+    @staticmethod
+    def canonicalize_bytes(node, params, includeList=None, excludeList=None,
+                           bufferSize=OutputSink.BUFFER_SIZE, cache=None):
+        """
+        Returns canonical form as UTF-8 bytearray, encoded chunk by chunk while
+        the tree is traversed instead of encoding the whole canonical string at
+        once. The bytearray is returned as is to avoid copying the output.
+
+        :param node:
+        :type node: xml.dom.minidom.Node
+        :param params:
+        :type params: Parameters | CompiledParameters
+        :param includeList:
+        :type includeList: list[xml.dom.minidom.Node]
+        :param excludeList: excluded nodes or predicate (e.g. QNameMatcher)
+        :type excludeList: list[xml.dom.minidom.Node] | set[xml.dom.minidom.Node] | callable
+        :param bufferSize:
+        :type bufferSize: int
+        :param cache:
+        :type cache: SubtreeCache
+        :rtype: bytearray
+        """
+        data = bytearray()
+        DOMCanonicalizer.canonicalize(node, params, includeList, excludeList, data, bufferSize,
+                                      cache)
+        return data
 
     @staticmethod
-    def canonicalize(node, params, includeList=None, excludeList=None):
-        return DOMCanonicalizer(node, includeList, excludeList, params).canonicalizeSubTree()
+    def iter_canonicalize(node, params, includeList=None, excludeList=None,
+                          bufferSize=OutputSink.BUFFER_SIZE, cache=None):
+        """
+        Generator yielding canonical form as UTF-8 chunks while the tree is traversed
+
+        :param node:
+        :type node: xml.dom.minidom.Node
+        :param params:
+        :type params: Parameters | CompiledParameters
+        :param includeList:
+        :type includeList: list[xml.dom.minidom.Node]
+        :param excludeList: excluded nodes or predicate (e.g. QNameMatcher)
+        :type excludeList: list[xml.dom.minidom.Node] | set[xml.dom.minidom.Node] | callable
+        :param bufferSize:
+        :type bufferSize: int
+        :param cache:
+        :type cache: SubtreeCache
+        :rtype: collections.Iterable[bytes]
+        """
+        chunks = list()
+        outputBuffer = OutputSink(chunks.append, bufferSize)
+        canonicalizer = DOMCanonicalizer(node, includeList, excludeList, params, outputBuffer, cache)
+        canonicalizer.chunks = chunks
+        for _ in canonicalizer.iterSubTree():
+            for chunk in chunks:
+                yield chunk
+            del chunks[:]
+        outputBuffer.flush()
+        for chunk in chunks:
+            yield chunk
 
     def canonicalizeSubTree(self):
+        for _ in self.iterSubTree():
+            pass
+        outputBuffer = self.canonicalizer.getOutputBlock()
+        if isinstance(outputBuffer, OutputSink):
+            outputBuffer.flush()
+            return None
+        return outputBuffer.getvalue()
+
+    def iterSubTree(self):
+        """
+        Traverses the tree, stopping every time some output chunks are ready
+        """
         if self.includeList is None:
-            self.process(self.node)
+            for _ in self.process(self.node):
+                yield
         else:
             self.processIncludeList()
             while len(self.nodes) > 0:
-                self.process(self.nodes[0])
-        return self.canonicalizer.getOutputBlock().getvalue()
+                for _ in self.process(self.nodes[0]):
+                    yield
 
     def processIncludeList(self):
-        allNodes = list()
+        isInExcludeList = self.canonicalizer.isInExcludeList
+        allNodes = set()
         for node in self.includeList:
+            path = list()
             n = node
-            while True:
-                if n not in allNodes:
-                    allNodes.append(n)
-                n = n.getParentNode()
-                if n is None:
+            while n is not None and n not in allNodes:
+                if isInExcludeList(n):
+                    # excluded node or ancestor, nothing of it is output
+                    path = None
                     break
-        allNodes.sort(cmp=compare_nodes)
-        self.nodes = allNodes
+                path.append(n)
+                n = n.parentNode
+            if path:
+                allNodes.update(path)
+        if self.documentOrder is None:
+            self.documentOrder = getDocumentOrder(self.node)
+        self.nodes = deque(sorted(allNodes, key=self.documentOrder.__getitem__))
 
     def process(self, node):
         """
+        Walks the subtree using an explicit stack, so the document depth is
+        not limited by the interpreter recursion limit
+
         :param node:
         :type node: xml.dom.mimidom.Node
         """
-        if self.canonicalizer.isInExcludeList(node):
-            return
-        nodeType = node.nodeType
-        if nodeType == Node.ELEMENT_NODE:
-            self.canonicalizer.processElement(node)
-        elif nodeType == Node.TEXT_NODE:
-            self.canonicalizer.processText(node)
-        elif nodeType == Node.PROCESSING_INSTRUCTION_NODE:
-            self.canonicalizer.processPI(node)
-        elif nodeType == Node.COMMENT_NODE:
-            self.canonicalizer.processComment(node)
-        elif nodeType == Node.CDATA_SECTION_NODE:
-            self.canonicalizer.processCData(node)
-        if len(self.nodes) > 0 and node == self.nodes[0]:
-            del self.nodes[0]
-        if node.hasChildNodes():
-            b = len(self.nodes) > 0 and node == self.nodes[0].getParentNode()
-            nl = node.childNodes
-            for i in range(len(nl)):
-                if not b or (len(self.nodes) > 0 and nl.item(i) == self.nodes[0]):
-                    self.process(nl.item(i))
-        if node.nodeType == Node.ELEMENT_NODE:
-            self.canonicalizer.processEndElement(node)
+        canonicalizer = self.canonicalizer
+        nodes = self.nodes
+        cache = self.cache
+        # subtrees being recorded for the cache: [element, key, outer output]
+        captures = list()
+        stack = list()
+        current = node
+        while True:
+            if current is not None and not canonicalizer.isInExcludeList(current):
+                nodeType = current.nodeType
+                if nodeType == Node.ELEMENT_NODE and cache is not None and cache.match(current) \
+                        and self.startCapture(current, captures):
+                    if self.chunks:
+                        yield
+                else:
+                    if nodeType == Node.ELEMENT_NODE:
+                        canonicalizer.processElement(current)
+                    elif nodeType == Node.TEXT_NODE:
+                        canonicalizer.processText(current)
+                    elif nodeType == Node.PROCESSING_INSTRUCTION_NODE:
+                        canonicalizer.processPI(current)
+                    elif nodeType == Node.COMMENT_NODE:
+                        canonicalizer.processComment(current)
+                    elif nodeType == Node.CDATA_SECTION_NODE:
+                        canonicalizer.processCData(current)
+                    if self.chunks:
+                        yield
+                    if len(nodes) > 0 and current is nodes[0]:
+                        nodes.popleft()
+                    # read once, adapters of other trees may build the list on access
+                    childNodes = current.childNodes
+                    if childNodes:
+                        # frame: [parent, children, next child index, include list filtering]
+                        b = len(nodes) > 0 and current is nodes[0].parentNode
+                        stack.append([current, childNodes, 0, b])
+                    elif nodeType == Node.ELEMENT_NODE:
+                        canonicalizer.processEndElement(current)
+                        if captures and captures[-1][0] is current:
+                            self.endCapture(captures)
+            current = None
+            if not stack:
+                break
+            frame = stack[-1]
+            parent, nl, i, b = frame
+            while i < len(nl):
+                child = nl[i]
+                i += 1
+                if not b or (len(nodes) > 0 and child is nodes[0]):
+                    current = child
+                    break
+            if current is None:
+                stack.pop()
+                if parent.nodeType == Node.ELEMENT_NODE:
+                    canonicalizer.processEndElement(parent)
+                    if captures and captures[-1][0] is parent:
+                        self.endCapture(captures)
+            else:
+                frame[2] = i
+
+    def getSubtreeKey(self, node):
+        """
+        :param node:
+        :type node: xml.dom.minidom.Node
+        :return: cache key of the subtree in the current namespace context
+        :rtype: tuple
+        """
+        canonicalizer = self.canonicalizer
+        preserveSpace = canonicalizer.preserveSpace and canonicalizer.preserveSpace[-1]
+        return (canonicalizer.parameters, canonicalizer.declaredPrefixes.getBindings(),
+                canonicalizer.usedPrefixes.getBindings(), preserveSpace,
+                getSubtreeHash(node, self.subtreeHashes))
+
+    def startCapture(self, node, captures):
+        """
+        Writes cached canonical form of the subtree or starts recording it
+
+        :param node:
+        :type node: xml.dom.minidom.Node
+        :param captures:
+        :type captures: list[list]
+        :return: True if the subtree was emitted from the cache
+        :rtype: bool
+        """
+        canonicalizer = self.canonicalizer
+        key = self.getSubtreeKey(node)
+        text = self.cache.get(key)
+        if text is not None:
+            canonicalizer.outputBuffer.write(text)
+            if not captures:
+                self.subtreeHashes.clear()
+            return True
+        captures.append([node, key, canonicalizer.outputBuffer])
+        canonicalizer.outputBuffer = StringIO()
+        return False
+
+    def endCapture(self, captures):
+        """
+        Stores recorded canonical form of the subtree and restores the output
+
+        :param captures:
+        :type captures: list[list]
+        """
+        canonicalizer = self.canonicalizer
+        node, key, outputBuffer = captures.pop()
+        text = canonicalizer.outputBuffer.getvalue()
+        canonicalizer.outputBuffer = outputBuffer
+        outputBuffer.write(text)
+        self.cache.put(key, text)
+        if not captures:
+            self.subtreeHashes.clear()
+
+
+class DocumentCanonicalizationSession(object):
+    """
+    Serves many canonicalizations of one document (e.g. every ds:Reference
+    of a signature). Document order and namespace scopes are indexed once and
+    shared, so include lists are not re-sorted against a fresh document walk
+    and ancestors of subtrees are not scanned for declarations every time.
+    The document must not be modified while the session is used.
+    """
+
+    def __init__(self, document, params=None):
+        """
+        :param document:
+        :type document: xml.dom.minidom.Document
+        :param params: default parameters of the session
+        :type params: Parameters | CompiledParameters
+        """
+        self.document = document  # type: xml.dom.minidom.Document
+        self.parameters = (Parameters() if params is None else params).compile()  # type: CompiledParameters
+        self.documentOrder = getDocumentOrder(document)  # type: dict
+        self.scopes = dict()  # type: dict
+
+    def getNamespaces(self, node):
+        """
+        Returns namespace bindings in scope of the element including its own
+        declarations. Scopes of elements without declarations share the dict
+        of their parent.
+
+        :param node:
+        :type node: xml.dom.minidom.Node
+        :return: prefix -> uri
+        :rtype: dict
+        """
+        chain = list()
+        current = node
+        scope = None
+        while current is not None and current.nodeType == Node.ELEMENT_NODE:
+            scope = self.scopes.get(current)
+            if scope is not None:
+                break
+            chain.append(current)
+            current = current.parentNode
+        if scope is None:
+            scope = dict()
+        for element in reversed(chain):
+            for attr in element.attributes.values():
+                name = attr.nodeName
+                if name.startswith('xmlns:'):
+                    prefix = name[6:]
+                elif name == 'xmlns':
+                    prefix = ''
+                else:
+                    continue
+                if scope is self.scopes.get(element.parentNode):
+                    scope = scope.copy()
+                scope[prefix] = attr.nodeValue
+            self.scopes[element] = scope
+        return scope
+
+    def canonicalize(self, node=None, includeList=None, excludeList=None, params=None,
+                     out=None, bufferSize=OutputSink.BUFFER_SIZE, cache=None):
+        """
+        :param node: canonicalized subtree, the whole document if None
+        :type node: xml.dom.minidom.Node
+        :param includeList:
+        :type includeList: list[xml.dom.minidom.Node]
+        :param excludeList: excluded nodes or predicate (e.g. QNameMatcher)
+        :type excludeList: list[xml.dom.minidom.Node] | set[xml.dom.minidom.Node] | callable
+        :param params: overrides parameters of the session
+        :type params: Parameters | CompiledParameters
+        :param out: target for UTF-8 chunks, see OutputSink
+        :type out: file | socket.socket | hashlib.HASH | bytearray | callable
+        :param bufferSize:
+        :type bufferSize: int
+        :param cache:
+        :type cache: SubtreeCache
+        :return: canonical text or None if out is given
+        :rtype: string
+        """
+        if node is None:
+            node = self.document
+        parentNamespaces = None
+        if node.parentNode is not None and node.parentNode.nodeType == Node.ELEMENT_NODE:
+            parentNamespaces = self.getNamespaces(node.parentNode)
+        outputBuffer = None if out is None else OutputSink(out, bufferSize)
+        canonicalizer = DOMCanonicalizer(node, includeList, excludeList, params or self.parameters,
+                                         outputBuffer, cache, parentNamespaces)
+        canonicalizer.documentOrder = self.documentOrder
+        return canonicalizer.canonicalizeSubTree()
+
+    def digest(self, node=None, algorithm='sha256', includeList=None, excludeList=None,
+               params=None, bufferSize=OutputSink.BUFFER_SIZE, cache=None):
+        """
+        :param node: canonicalized subtree, the whole document if None
+        :type node: xml.dom.minidom.Node
+        :param algorithm: any name accepted by hashlib.new
+        :type algorithm: string
+        :param includeList:
+        :type includeList: list[xml.dom.minidom.Node]
+        :param excludeList: excluded nodes or predicate (e.g. QNameMatcher)
+        :type excludeList: list[xml.dom.minidom.Node] | set[xml.dom.minidom.Node] | callable
+        :param params: overrides parameters of the session
+        :type params: Parameters | CompiledParameters
+        :param bufferSize:
+        :type bufferSize: int
+        :param cache:
+        :type cache: SubtreeCache
+        :return: raw digest value
+        :rtype: bytes
+        """
+        h = hashlib.new(algorithm)
+        self.canonicalize(node, includeList, excludeList, params, h, bufferSize, cache)
+        return h.digest()
+
+
+class PullDOMExpatParser(ExpatParser):
+    """
+    SAX parser passing qualified element names to PullDOMBuilder and
+    reporting only attributes specified in the document, like minidom does
+    """
+
+    def reset(self):
+        ExpatParser.reset(self)
+        self._parser.specified_attributes = True
+
+    def start_element_ns(self, name, attrs):
+        """
+        :param name: uri, local name and prefix separated by spaces
+        :type name: string
+        :param attrs:
+        :type attrs: dict
+        """
+        parts = name.split()
+        self._cont_handler.qName = parts[2] + ':' + parts[1] if len(parts) == 3 else parts[-1]
+        ExpatParser.start_element_ns(self, name, attrs)
+
+
+class PullDOMBuilder(pulldom.PullDOM):
+    """
+    PullDOM keeping qualified names of the source and CDATA sections.
+    pulldom.PullDOM rebuilds prefixes from the latest declaration of each
+    namespace URI and reports CDATA as text.
+    """
+
+    def __init__(self, documentFactory=None):
+        """
+        :param documentFactory:
+        :type documentFactory: xml.dom.minidom.DOMImplementation
+        """
+        pulldom.PullDOM.__init__(self, documentFactory)
+        self.qName = None  # type: string
+        self.cdata = None  # type: list[string]
+        self.inDTD = False  # type: bool
+
+    def startElementNS(self, name, tagName, attrs):
+        """
+        :param name: uri and local name
+        :type name: tuple
+        :param tagName:
+        :type tagName: string
+        :param attrs:
+        :type attrs: xml.sax.xmlreader.AttributesNSImpl
+        """
+        # namespace declarations are added by PullDOM
+        pulldom.PullDOM.startElementNS(self, name, tagName or self.qName, AttributesNSImpl({}, {}))
+        node = self.elementStack[-1]
+        for attrName, value in attrs.items():
+            uri, localName = attrName
+            if uri:
+                attr = self.document.createAttributeNS(uri, attrs.getQNameByName(attrName))
+                node.setAttributeNodeNS(attr)
+            else:
+                attr = self.document.createAttribute(localName)
+                node.setAttributeNode(attr)
+            attr.value = value
+
+    def characters(self, chars):
+        """
+        :param chars:
+        :type chars: string
+        """
+        if self.cdata is None:
+            pulldom.PullDOM.characters(self, chars)
+        else:
+            self.cdata.append(chars)
+
+    def startCDATA(self):
+        self.cdata = list()
+
+    def endCDATA(self):
+        data = ''.join(self.cdata)
+        self.cdata = None
+        if data:
+            node = self.document.createCDATASection(data)
+            self.lastEvent[1] = [(pulldom.CHARACTERS, node), None]
+            self.lastEvent = self.lastEvent[1]
+
+    def comment(self, s):
+        """
+        :param s:
+        :type s: string
+        """
+        if not self.inDTD:
+            pulldom.PullDOM.comment(self, s)
+
+    def startDTD(self, name, publicId, systemId):
+        self.inDTD = True
+
+    def endDTD(self):
+        self.inDTD = False
+
+
+class PullDOMEventStream(pulldom.DOMEventStream):
+    """ DOMEventStream producing events with PullDOMBuilder """
+
+    def reset(self):
+        self.pulldom = PullDOMBuilder()
+        self.parser.setFeature(feature_namespaces, 1)
+        self.parser.setContentHandler(self.pulldom)
+        self.parser.setProperty(property_lexical_handler, self.pulldom)
+
+
+class PullDOMCanonicalizer(object):
+    """
+    Canonicalizes selected subtrees of a document read with xml.dom.pulldom.
+    Only target elements are expanded to DOM, everything else is streamed
+    past. Open ancestors of the current event are kept linked to each other
+    with their attributes only, so namespace declarations and xml:space in
+    scope of a target are resolved by the handler in the same way as for a
+    subtree of a parsed document.
+    """
+
+    ID_ATTRIBUTES = ('Id', 'ID', 'id')  # type: tuple[string]
+    # events of a whole read part are built before the first one is returned
+    READ_SIZE = pulldom.default_bufsize  # type: int
+
+    def __init__(self, params=None, ids=None, names=None):
+        """
+        :param params:
+        :type params: Parameters | CompiledParameters
+        :param ids: values of Id attributes (any namespace) of target elements
+        :type ids: collections.Iterable[string]
+        :param names: expanded names of target elements written as {uri}localName
+        :type names: collections.Iterable[string]
+        """
+        self.parameters = (Parameters() if params is None else params).compile()  # type: CompiledParameters
+        self.ids = set() if ids is None else set(ids)  # type: set[string]
+        self.matcher = QNameMatcher(*(names or ()))  # type: QNameMatcher
+
+    @staticmethod
+    def canonicalize(source, params, ids=None, names=None):
+        """
+        :param source: xml document text or file-like object
+        :type source: string
+        :param params:
+        :type params: Parameters | CompiledParameters
+        :param ids: values of Id attributes (any namespace) of target elements
+        :type ids: collections.Iterable[string]
+        :param names: expanded names of target elements written as {uri}localName
+        :type names: collections.Iterable[string]
+        :return: canonical texts of targets in document order
+        :rtype: list[string]
+        """
+        canonicalizer = PullDOMCanonicalizer(params, ids, names)
+        return [text for node, text in canonicalizer.iterTargets(source)]
+
+    def isTarget(self, node):
+        """
+        :param node:
+        :type node: xml.dom.minidom.Node
+        :rtype: bool
+        """
+        if self.matcher(node):
+            return True
+        if self.ids:
+            for attr in node.attributes.values():
+                if attr.localName in self.ID_ATTRIBUTES and attr.nodeValue in self.ids:
+                    return True
+        return False
+
+    def iterTargets(self, source, readSize=READ_SIZE):
+        """
+        Generator yielding target elements with their canonical form. Targets
+        nested into another target are part of its output and not yielded.
+        Yielded nodes are detached from the ancestors and hold only their own
+        subtree.
+
+        :param source: xml document text or file-like object
+        :type source: string
+        :param readSize: size of parts read from source and fed to the parser
+        :type readSize: int
+        :rtype: collections.Iterable[tuple[xml.dom.minidom.Node, string]]
+        """
+        if not hasattr(source, 'read'):
+            if not isinstance(source, bytes):
+                source = source.encode('utf-8')
+            source = BytesIO(source)
+        parser = PullDOMExpatParser()
+        parser.setFeature(feature_external_ges, False)
+        events = PullDOMEventStream(source, parser, readSize)
+        ancestors = list()
+        for event, node in events:
+            if event == pulldom.START_ELEMENT:
+                if ancestors:
+                    ancestors[-1].appendChild(node)
+                if not self.isTarget(node):
+                    ancestors.append(node)
+                    continue
+                events.expandNode(node)
+                node.normalize()
+                text = DOMCanonicalizer(node, None, None, self.parameters).canonicalizeSubTree()
+                if node.parentNode is not None:
+                    node.parentNode.removeChild(node)
+                yield node, text
+            elif event == pulldom.END_ELEMENT:
+                node = ancestors.pop()
+                if ancestors:
+                    ancestors[-1].removeChild(node)
+
+
+class StreamNodeList(list):
+    """ Minimal NamedNodeMap/NodeList replacement for stream nodes """
+
+    def item(self, index):
+        """
+        :param index:
+        :type index: int
+        :return:
+        :rtype: StreamNode
+        """
+        return self[index]
+
+    def values(self):
+        """
+        :return:
+        :rtype: list[StreamNode]
+        """
+        return self
+
+
+class StreamNode(object):
+    """
+    Lightweight node built from a parser event. It exposes the subset of
+    xml.dom.minidom.Node interface used by DOMCanonicalizerHandler.
+    """
+
+    __slots__ = ('nodeType', 'nodeName', 'prefix', 'localName',
+                 'namespaceURI', 'nodeValue', 'parentNode', 'attributes', 'childNodes')
+
+    def __init__(self, nodeType, nodeName=None, nodeValue=None, parentNode=None):
+        """
+        :param nodeType:
+        :type nodeType: int
+        :param nodeName:
+        :type nodeName: string
+        :param nodeValue:
+        :type nodeValue: string
+        :param parentNode:
+        :type parentNode: StreamNode
+        """
+        self.nodeType = nodeType  # type: int
+        self.nodeName = nodeName  # type: string
+        self.nodeValue = nodeValue  # type: string
+        self.parentNode = parentNode  # type: StreamNode
+        self.prefix = None  # type: string
+        self.localName = None  # type: string
+        self.namespaceURI = None  # type: string
+        self.attributes = None  # type: StreamNodeList
+        self.childNodes = ()  # type: StreamNodeList
+        if nodeName is not None:
+            idx = nodeName.find(':')
+            if idx > -1:
+                self.prefix = nodeName[:idx]
+                self.localName = nodeName[idx+1:]
+            else:
+                self.localName = nodeName
+
+
+class StreamingCanonicalizer(object):
+    """
+    Canonicalizes a document directly from expat parser events without
+    building a DOM tree. Only the chain of currently open elements is kept
+    in memory, so memory usage depends on the document depth and not on
+    the document size. Namespace visibility of QName aware elements
+    (qnameAwareElements, qnameAwareXPathElements) depends on their text, so
+    such elements are buffered as whole subtrees and canonicalized when
+    their end tag is reached.
+    """
+
+    READ_SIZE = 64 * 1024  # type: int
+
+    def __init__(self, params=None, out=None, bufferSize=OutputSink.BUFFER_SIZE,
+                 excludeFilter=None):
+        """
+        :param params:
+        :type params: Parameters | CompiledParameters
+        :param out: target for UTF-8 chunks, see OutputSink
+        :type out: file | socket.socket | hashlib.HASH | bytearray | callable
+        :param bufferSize:
+        :type bufferSize: int
+        :param excludeFilter: predicate for excluded elements and attributes
+        :type excludeFilter: callable
+        """
+        self.outputBuffer = StringIO() if out is None else OutputSink(out, bufferSize)
+        parameters = Parameters() if params is None else params
+        self.canonicalizer = createHandler(
+            None, parameters, excludeFilter, self.outputBuffer)  # type: DOMCanonicalizerHandler
+        self.current = None  # type: StreamNode
+        self.skipDepth = 0  # type: int
+        self.namespaces = [{'xml': XML_NAMESPACE, 'xmlns': XMLNS_NAMESPACE}]  # type: list[dict]
+        self.textData = list()  # type: list[string]
+        self.inCData = False  # type: bool
+        # open elements of the buffered QName aware subtree
+        self.buffered = list()  # type: list[StreamNode]
+
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.ordered_attributes = True
+        parser.specified_attributes = True
+        parser.StartElementHandler = self.startElement
+        parser.EndElementHandler = self.endElement
+        parser.CharacterDataHandler = self.characters
+        parser.StartCdataSectionHandler = self.startCData
+        parser.EndCdataSectionHandler = self.endCData
+        parser.CommentHandler = self.comment
+        parser.ProcessingInstructionHandler = self.processingInstruction
+        self.parser = parser
+
+    @staticmethod
+    def canonicalize(source, params, out=None, bufferSize=OutputSink.BUFFER_SIZE,
+                     excludeFilter=None):
+        """
+        :param source: xml document text or file-like object
+        :type source: string
+        :param params:
+        :type params: Parameters | CompiledParameters
+        :param out: target for UTF-8 chunks, see OutputSink
+        :type out: file | socket.socket | hashlib.HASH | bytearray | callable
+        :param bufferSize:
+        :type bufferSize: int
+        :param excludeFilter: predicate for excluded elements and attributes
+        :type excludeFilter: callable
+        :return: canonical text or None if out is given
+        :rtype: string
+        """
+        canonicalizer = StreamingCanonicalizer(params, out, bufferSize, excludeFilter)
+        if hasattr(source, 'read'):
+            while True:
+                data = source.read(StreamingCanonicalizer.READ_SIZE)
+                if not data:
+                    break
+                canonicalizer.feed(data)
+        else:
+            canonicalizer.feed(source)
+        return canonicalizer.close()
+
+    @staticmethod
+    def canonicalize_bytes(source, params, bufferSize=OutputSink.BUFFER_SIZE,
+                           excludeFilter=None):
+        """
+        :param source: xml document text or file-like object
+        :type source: string
+        :param params:
+        :type params: Parameters | CompiledParameters
+        :param bufferSize:
+        :type bufferSize: int
+        :param excludeFilter: predicate for excluded elements and attributes
+        :type excludeFilter: callable
+        :return: canonical form encoded to UTF-8, returned without a copy
+        :rtype: bytearray
+        """
+        data = bytearray()
+        StreamingCanonicalizer.canonicalize(source, params, data, bufferSize, excludeFilter)
+        return data
+
+    def feed(self, data):
+        """
+        :param data: next part of the document, text is encoded to UTF-8
+        :type data: string
+        """
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.parser.Parse(data, False)
+
+    def close(self):
+        """
+        :return: canonical form of the fed document or None if out is given
+        :rtype: string
+        """
+        self.parser.Parse('', True)
+        if isinstance(self.outputBuffer, OutputSink):
+            self.outputBuffer.flush()
+            return None
+        return self.outputBuffer.getvalue()
+
+    def startElement(self, name, attrs):
+        """
+        :param name:
+        :type name: string
+        :param attrs: flat list of names and values
+        :type attrs: list[string]
+        """
+        if self.skipDepth:
+            self.skipDepth += 1
+            return
+        self.flushText()
+        node = StreamNode(Node.ELEMENT_NODE, name, None, self.current)
+        namespaces = self.namespaces[-1]
+        attributes = StreamNodeList()
+        for i in range(0, len(attrs), 2):
+            attr = StreamNode(Node.ATTRIBUTE_NODE, attrs[i], attrs[i+1])
+            if attr.prefix == 'xmlns' or attr.nodeName == 'xmlns':
+                if namespaces is self.namespaces[-1]:
+                    namespaces = namespaces.copy()
+                namespaces[attr.localName if attr.prefix else ''] = attr.nodeValue
+            attributes.append(attr)
+        for attr in attributes:
+            if attr.prefix is not None:
+                attr.namespaceURI = namespaces.get(attr.prefix)
+            elif attr.nodeName == 'xmlns':
+                attr.namespaceURI = XMLNS_NAMESPACE
+        node.attributes = attributes
+        node.namespaceURI = namespaces.get(node.prefix or '') or None
+        if self.canonicalizer.isInExcludeList(node):
+            self.skipDepth = 1
+            return
+        self.namespaces.append(namespaces)
+        self.current = node
+        if self.buffered:
+            self.appendChild(node)
+            self.buffered.append(node)
+        elif self.canonicalizer.qNameAware and any(self.canonicalizer.getQNameFlags(
+                node.namespaceURI or '', node.localName)):
+            node.childNodes = StreamNodeList()
+            self.buffered.append(node)
+        else:
+            self.canonicalizer.processElement(node)
+
+    def endElement(self, name):
+        """
+        :param name:
+        :type name: string
+        """
+        if self.skipDepth:
+            self.skipDepth -= 1
+            return
+        self.flushText()
+        node = self.current
+        if self.buffered:
+            self.buffered.pop()
+            if not self.buffered:
+                self.replay(node)
+        else:
+            self.canonicalizer.processEndElement(node)
+        self.namespaces.pop()
+        self.current = node.parentNode
+
+    def characters(self, data):
+        """
+        :param data:
+        :type data: string
+        """
+        if not self.skipDepth:
+            self.textData.append(data)
+
+    def startCData(self):
+        if self.skipDepth:
+            return
+        self.flushText()
+        self.inCData = True
+
+    def endCData(self):
+        if self.skipDepth:
+            return
+        data = ''.join(self.textData)
+        del self.textData[:]
+        self.inCData = False
+        if data:
+            node = StreamNode(Node.CDATA_SECTION_NODE, None, data, self.current)
+            if self.buffered:
+                self.appendChild(node)
+            else:
+                self.canonicalizer.processCData(node)
+
+    def comment(self, data):
+        """
+        :param data:
+        :type data: string
+        """
+        if self.skipDepth:
+            return
+        self.flushText()
+        node = StreamNode(Node.COMMENT_NODE, None, data, self.current)
+        if self.buffered:
+            self.appendChild(node)
+        else:
+            self.canonicalizer.processComment(node)
+
+    def processingInstruction(self, target, data):
+        """
+        :param target:
+        :type target: string
+        :param data:
+        :type data: string
+        """
+        if self.skipDepth:
+            return
+        self.flushText()
+        node = StreamNode(Node.PROCESSING_INSTRUCTION_NODE, target, data, self.current)
+        if self.buffered:
+            self.appendChild(node)
+        else:
+            self.canonicalizer.processPI(node)
+
+    def flushText(self):
+        """ Passes collected character data to the handler as a single text node """
+        if self.textData and not self.inCData:
+            data = ''.join(self.textData)
+            del self.textData[:]
+            node = StreamNode(Node.TEXT_NODE, None, data, self.current)
+            if self.buffered:
+                self.appendChild(node)
+            else:
+                self.canonicalizer.processText(node)
+
+    def appendChild(self, node):
+        """
+        Adds node to the open element of the buffered subtree
+
+        :param node:
+        :type node: StreamNode
+        """
+        if node.nodeType == Node.ELEMENT_NODE:
+            node.childNodes = StreamNodeList()
+        self.buffered[-1].childNodes.append(node)
+
+    def replay(self, node):
+        """
+        Passes the buffered subtree to the handler in document order
+
+        :param node:
+        :type node: StreamNode
+        """
+        canonicalizer = self.canonicalizer
+        canonicalizer.processElement(node)
+        stack = [(node, iter(node.childNodes))]
+        while stack:
+            parent, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                canonicalizer.processEndElement(parent)
+            elif child.nodeType == Node.ELEMENT_NODE:
+                canonicalizer.processElement(child)
+                stack.append((child, iter(child.childNodes)))
+            elif child.nodeType == Node.TEXT_NODE:
+                canonicalizer.processText(child)
+            elif child.nodeType == Node.CDATA_SECTION_NODE:
+                canonicalizer.processCData(child)
+            elif child.nodeType == Node.COMMENT_NODE:
+                canonicalizer.processComment(child)
+            else:
+                canonicalizer.processPI(child)
+
+
+def canonicalize_file(path, params=None, out=None, bufferSize=OutputSink.BUFFER_SIZE,
+                      excludeFilter=None):
+    """
+    Canonicalizes xml file without reading it into memory: the file is mapped
+    and fed to StreamingCanonicalizer in READ_SIZE slices
+
+    :param path:
+    :type path: string
+    :param params:
+    :type params: Parameters | CompiledParameters
+    :param out: target for UTF-8 chunks, see OutputSink
+    :type out: file | socket.socket | hashlib.HASH | bytearray | callable
+    :param bufferSize:
+    :type bufferSize: int
+    :param excludeFilter: predicate for excluded elements and attributes
+    :type excludeFilter: callable
+    :return: canonical text or None if out is given
+    :rtype: string
+    """
+    canonicalizer = StreamingCanonicalizer(params, out, bufferSize, excludeFilter)
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files can not be mapped
+            return canonicalizer.close()
+        if hasattr(data, 'madvise'):
+            data.madvise(mmap.MADV_SEQUENTIAL)
+        try:
+            for offset in range(0, len(data), StreamingCanonicalizer.READ_SIZE):
+                canonicalizer.feed(data[offset:offset + StreamingCanonicalizer.READ_SIZE])
+        finally:
+            data.close()
+    return canonicalizer.close()
+
+
+BatchResult = namedtuple('BatchResult', ['index', 'value', 'error'])
+
+
+class BatchWorker(object):
+    """
+    Canonicalizes documents of a batch. Parameters are passed to every
+    worker process once instead of being sent with each document.
+    """
+
+    def __init__(self, params, algorithm):
+        """
+        :param params:
+        :type params: CompiledParameters
+        :param algorithm: hashlib algorithm name or None for canonical bytes
+        :type algorithm: string
+        """
+        self.params = params  # type: CompiledParameters
+        self.algorithm = algorithm  # type: string
+
+    def __call__(self, task):
+        """
+        :param task: document index and text
+        :type task: tuple
+        :return:
+        :rtype: BatchResult
+        """
+        index, data = task
+        try:
+            if self.algorithm is None:
+                chunks = list()
+                StreamingCanonicalizer.canonicalize(data, self.params, chunks.append)
+                return BatchResult(index, b''.join(chunks), None)
+            h = hashlib.new(self.algorithm)
+            StreamingCanonicalizer.canonicalize(data, self.params, h)
+            return BatchResult(index, h.digest(), None)
+        except Exception as e:
+            return BatchResult(index, None, '{}: {}'.format(e.__class__.__name__, e))
+
+
+batchWorker = None  # type: BatchWorker
+
+
+def initBatchWorker(params, algorithm):
+    """
+    Pool initializer creating the worker of the current process
+    """
+    global batchWorker
+    batchWorker = BatchWorker(params, algorithm)
+
+
+def runBatchWorker(task):
+    """
+    :param task:
+    :type task: tuple
+    :return:
+    :rtype: BatchResult
+    """
+    return batchWorker(task)
+
+
+def canonicalize_many(documents, params=None, workers=None, chunksize=16, ordered=True,
+                      algorithm=None):
+    """
+    Canonicalizes independent documents in a process pool
+
+    :param documents: xml documents as bytes or text, text is encoded to UTF-8
+    :type documents: collections.Iterable[bytes | string]
+    :param params:
+    :type params: Parameters | CompiledParameters
+    :param workers: number of processes, cpu count if None, 1 runs in the current process
+    :type workers: int
+    :param chunksize: number of documents sent to a process at once
+    :type chunksize: int
+    :param ordered: yield results in the order of documents
+    :type ordered: bool
+    :param algorithm: hashlib algorithm name to get digests instead of canonical bytes
+    :type algorithm: string
+    :return: results with canonical bytes or digest as value, or error message
+    :rtype: collections.Iterable[BatchResult]
+    """
+    parameters = (Parameters() if params is None else params).compile()
+    tasks = enumerate(documents)
+    if workers == 1:
+        worker = BatchWorker(parameters, algorithm)
+        for task in tasks:
+            yield worker(task)
+        return
+    pool = multiprocessing.Pool(workers, initBatchWorker, (parameters, algorithm))
+    try:
+        if ordered:
+            results = pool.imap(runBatchWorker, tasks, chunksize)
+        else:
+            results = pool.imap_unordered(runBatchWorker, tasks, chunksize)
+        for result in results:
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class ElementTreeNode(object):
+    """
+    Adapter exposing an xml.etree.ElementTree element (or the document when
+    element is None) through the minidom interface used by
+    DOMCanonicalizerHandler and DOMCanonicalizer.
+    """
+
+    __slots__ = ('owner', 'element', 'nodeType', 'nodeName', 'prefix', 'localName',
+                 'namespaceURI', 'nodeValue', 'parentNode', 'attributes',
+                 'namespaces', '__weakref__')
+
+    def __init__(self, owner, element, parentNode):
+        """
+        :param owner:
+        :type owner: ElementTreeCanonicalizer
+        :param element:
+        :type element: xml.etree.ElementTree.Element
+        :param parentNode:
+        :type parentNode: ElementTreeNode
+        """
+        self.owner = owner  # type: ElementTreeCanonicalizer
+        self.element = element  # type: xml.etree.ElementTree.Element
+        self.parentNode = parentNode  # type: ElementTreeNode
+        self.nodeValue = None  # type: string
+        if element is None:
+            self.nodeType = Node.DOCUMENT_NODE  # type: int
+            self.nodeName = '#document'  # type: string
+            self.prefix = None  # type: string
+            self.localName = None  # type: string
+            self.namespaceURI = None  # type: string
+            self.attributes = None  # type: StreamNodeList
+            self.namespaces = {'xml': XML_NAMESPACE}  # type: dict
+            return
+        self.nodeType = Node.ELEMENT_NODE
+        namespaces = parentNode.namespaces
+        attributes = StreamNodeList()
+        declarations = owner.namespaces.get(element)
+        if declarations:
+            namespaces = namespaces.copy()
+            for prefix, uri in declarations:
+                namespaces[prefix] = uri
+                attr = StreamNode(Node.ATTRIBUTE_NODE, 'xmlns:' + prefix if prefix else 'xmlns', uri)
+                attr.namespaceURI = XMLNS_NAMESPACE
+                attributes.append(attr)
+        self.namespaces = namespaces
+        # prefixes recorded by the parser: (element prefix, attribute name -> prefix)
+        tagPrefix, attrPrefixes = owner.sourcePrefixes.get(element, (None, None))
+        uri, localName = self.splitTag(element.tag)
+        if uri:
+            self.prefix = self.findPrefix(uri, False) if tagPrefix is None else tagPrefix
+        else:
+            self.prefix = None
+        self.localName = localName
+        self.namespaceURI = uri or None
+        self.nodeName = self.prefix + ':' + localName if self.prefix else localName
+        for name, value in element.items():
+            uri, localName = self.splitTag(name)
+            if uri:
+                prefix = attrPrefixes.get(name) if attrPrefixes else None
+                if prefix is None:
+                    prefix = self.findPrefix(uri, True)
+                attr = StreamNode(Node.ATTRIBUTE_NODE, prefix + ':' + localName, value)
+                attr.namespaceURI = uri
+            else:
+                attr = StreamNode(Node.ATTRIBUTE_NODE, localName, value)
+            attributes.append(attr)
+        self.attributes = attributes
+
+    @property
+    def childNodes(self):
+        """
+        Child adapters are not kept by the node, so a visited subtree can be
+        released as soon as the walker leaves it
+
+        :rtype: list
+        """
+        return self.owner.createChildNodes(self)
+
+    def hasChildNodes(self):
+        """
+        :rtype: bool
+        """
+        return bool(self.childNodes)
+
+    def splitTag(self, tag):
+        """
+        :param tag: name in {uri}localName form
+        :type tag: string
+        :return: uri and local name
+        :rtype: tuple
+        """
+        if tag[:1] == '{':
+            uri, localName = tag[1:].split('}', 1)
+            return uri, localName
+        return '', tag
+
+    def findPrefix(self, uri, attribute):
+        """
+        Finds the prefix bound to uri for names without a prefix recorded by
+        the parser. Guessing among several prefixes would change the
+        canonical form, so such bindings are reported as errors.
+
+        :param uri:
+        :type uri: string
+        :param attribute: default namespace can not be used for attributes
+        :type attribute: bool
+        :return:
+        :rtype: string
+        """
+        prefixes = [prefix for prefix, value in self.namespaces.items()
+                    if value == uri and (prefix or not attribute)]
+        if len(prefixes) == 1:
+            return prefixes[0]
+        if not prefixes:
+            raise Exception('prefix for namespace {} is not declared!'.format(uri))
+        raise Exception('namespace {} is bound to prefixes {}, prefix of the source is unknown!'.format(
+            uri, ', '.join(sorted(prefixes))))
+
+
+class ElementTreeNodeList(object):
+    """
+    Child nodes of ElementTreeNode. Only child elements and text strings are
+    kept, node adapters are created on access.
+    """
+
+    __slots__ = ('parentNode', 'items')
+
+    def __init__(self, parentNode, items):
+        """
+        :param parentNode:
+        :type parentNode: ElementTreeNode
+        :param items: child elements and text strings in document order
+        :type items: list
+        """
+        self.parentNode = parentNode  # type: ElementTreeNode
+        self.items = items  # type: list
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        """
+        :param index:
+        :type index: int
+        :rtype: ElementTreeNode | StreamNode
+        """
+        return self.parentNode.owner.createNode(self.items[index], self.parentNode)
+
+    def __iter__(self):
+        parentNode = self.parentNode
+        createNode = parentNode.owner.createNode
+        for item in self.items:
+            yield createNode(item, parentNode)
+
+    def item(self, index):
+        """
+        :param index:
+        :type index: int
+        :rtype: ElementTreeNode | StreamNode
+        """
+        return self[index]
+
+
+class ElementTreeBuilder(object):
+    """
+    Builds an ElementTree tree from expat events keeping namespace
+    declarations and prefixes of qualified names for ElementTreeCanonicalizer
+    """
+
+    def __init__(self):
+        self.builder = ElementTree.TreeBuilder()  # type: xml.etree.ElementTree.TreeBuilder
+        self.root = None  # type: xml.etree.ElementTree.Element
+        self.namespaces = dict()  # type: dict
+        self.sourcePrefixes = dict()  # type: dict
+        self.declarations = list()  # type: list[tuple]
+        # expat name -> (name in {uri}localName form, prefix), shares strings between elements
+        self.names = dict()  # type: dict
+        # (element prefix, None) records shared by elements without prefixed attributes
+        self.tagPrefixes = dict()  # type: dict
+
+        parser = expat.ParserCreate(namespace_separator=' ')
+        parser.namespace_prefixes = True
+        parser.buffer_text = True
+        parser.ordered_attributes = True
+        parser.specified_attributes = True
+        parser.StartNamespaceDeclHandler = self.startNamespace
+        parser.StartElementHandler = self.startElement
+        parser.EndElementHandler = self.endElement
+        parser.CharacterDataHandler = self.builder.data
+        self.parser = parser
+
+    def feed(self, data):
+        """
+        :param data: next part of the document
+        :type data: bytes
+        """
+        self.parser.Parse(data, False)
+
+    def close(self):
+        """
+        :rtype: ElementTreeCanonicalizer
+        """
+        self.parser.Parse(b'', True)
+        self.builder.close()
+        return ElementTreeCanonicalizer(self.root, self.namespaces, self.sourcePrefixes)
+
+    def splitName(self, name):
+        """
+        :param name: uri, local name and prefix separated by spaces
+        :type name: string
+        :return: name in {uri}localName form and prefix, None without namespace
+        :rtype: tuple
+        """
+        result = self.names.get(name)
+        if result is None:
+            parts = name.split(' ')
+            if len(parts) == 1:
+                result = (name, None)
+            else:
+                result = ('{%s}%s' % (parts[0], parts[1]), parts[2] if len(parts) == 3 else '')
+            self.names[name] = result
+        return result
+
+    def startNamespace(self, prefix, uri):
+        """
+        :param prefix:
+        :type prefix: string
+        :param uri:
+        :type uri: string
+        """
+        self.declarations.append((prefix or '', uri or ''))
+
+    def startElement(self, name, attrs):
+        """
+        :param name:
+        :type name: string
+        :param attrs: flat list of names and values
+        :type attrs: list[string]
+        """
+        tag, tagPrefix = self.splitName(name)
+        attrib = dict()
+        attrPrefixes = None
+        for i in range(0, len(attrs), 2):
+            attrName, prefix = self.splitName(attrs[i])
+            attrib[attrName] = attrs[i+1]
+            if prefix:
+                if attrPrefixes is None:
+                    attrPrefixes = dict()
+                attrPrefixes[attrName] = prefix
+        element = self.builder.start(tag, attrib)
+        if self.root is None:
+            self.root = element
+        if self.declarations:
+            self.namespaces[element] = self.declarations
+            self.declarations = list()
+        if attrPrefixes is not None:
+            self.sourcePrefixes[element] = (tagPrefix, attrPrefixes)
+        elif tagPrefix is not None:
+            self.sourcePrefixes[element] = self.tagPrefixes.setdefault(tagPrefix, (tagPrefix, None))
+
+    def endElement(self, name):
+        """
+        :param name:
+        :type name: string
+        """
+        self.builder.end(self.splitName(name)[0])
+
+
+class ElementTreeCanonicalizer(object):
+    """
+    Canonicalizes xml.etree.ElementTree trees through ElementTreeNode adapters.
+
+    ElementTree does not keep namespace prefixes, so parse() records
+    namespace declarations and prefixes of element and attribute names while
+    building the tree. For trees built elsewhere prefixes are recovered from
+    the declarations, a namespace bound to several prefixes in scope is an
+    error. CDATA sections are seen as ordinary text, comments and processing
+    instructions are dropped.
+    """
+
+    def __init__(self, root, namespaces=None, sourcePrefixes=None):
+        """
+        :param root:
+        :type root: xml.etree.ElementTree.Element
+        :param namespaces: element -> namespace declarations as (prefix, uri) list
+        :type namespaces: dict
+        :param sourcePrefixes: element -> (element prefix, attribute name -> prefix)
+        :type sourcePrefixes: dict
+        """
+        self.root = root  # type: xml.etree.ElementTree.Element
+        self.namespaces = dict() if namespaces is None else namespaces  # type: dict
+        self.sourcePrefixes = dict() if sourcePrefixes is None else sourcePrefixes  # type: dict
+        self.parents = None  # type: dict
+        self.document = ElementTreeNode(self, None, None)  # type: ElementTreeNode
+        # adapters referenced by the walker, include or exclude lists
+        self.nodes = weakref.WeakValueDictionary()  # type: weakref.WeakValueDictionary
+
+    @staticmethod
+    def parse(source):
+        """
+        :param source: xml document bytes or file-like object
+        :type source: bytes
+        :return:
+        :rtype: ElementTreeCanonicalizer
+        """
+        if not hasattr(source, 'read'):
+            if not isinstance(source, bytes):
+                source = source.encode('utf-8')
+            source = BytesIO(source)
+        builder = ElementTreeBuilder()
+        while True:
+            data = source.read(StreamingCanonicalizer.READ_SIZE)
+            if not data:
+                break
+            builder.feed(data)
+        return builder.close()
+
+    def canonicalize(self, params, element=None, includeList=None, excludeList=None,
+                     out=None, bufferSize=OutputSink.BUFFER_SIZE, cache=None):
+        """
+        :param params:
+        :type params: Parameters | CompiledParameters
+        :param element: canonicalized subtree, the whole document if None
+        :type element: xml.etree.ElementTree.Element
+        :param includeList:
+        :type includeList: list[xml.etree.ElementTree.Element]
+        :param excludeList: excluded elements or predicate (e.g. QNameMatcher)
+        :type excludeList: list[xml.etree.ElementTree.Element] | callable
+        :param out: target for UTF-8 chunks, see OutputSink
+        :type out: file | socket.socket | hashlib.HASH | bytearray | callable
+        :param bufferSize:
+        :type bufferSize: int
+        :param cache:
+        :type cache: SubtreeCache
+        :return: canonical text or None if out is given
+        :rtype: string
+        """
+        node = self.document if element is None else self.getNode(element)
+        if includeList is not None:
+            includeList = [self.getNode(e) for e in includeList]
+        if excludeList is not None and not callable(excludeList):
+            excludeList = set(self.getNode(e) for e in excludeList)
+        outputBuffer = None if out is None else OutputSink(out, bufferSize)
+        return DOMCanonicalizer(node, includeList, excludeList, params, outputBuffer,
+                                cache).canonicalizeSubTree()
+
+    def getNode(self, element):
+        """
+        Returns the adapter of element creating adapters of its ancestors
+
+        :param element:
+        :type element: xml.etree.ElementTree.Element
+        :return:
+        :rtype: ElementTreeNode
+        """
+        chain = list()
+        current = element
+        node = self.nodes.get(current)
+        while node is None:
+            chain.append(current)
+            if current is self.root:
+                node = self.document
+                break
+            if self.parents is None:
+                self.parents = dict((c, p) for p in self.root.iter() for c in p)
+            current = self.parents[current]
+            node = self.nodes.get(current)
+        for current in reversed(chain):
+            node = ElementTreeNode(self, current, node)
+            self.nodes[current] = node
+        return node
+
+    def createChildNodes(self, node):
+        """
+        Lists child elements and text/tail strings of node
+
+        :param node:
+        :type node: ElementTreeNode
+        :return:
+        :rtype: ElementTreeNodeList
+        """
+        if node.element is None:
+            return ElementTreeNodeList(node, [self.root])
+        items = list()
+        element = node.element
+        if element.text:
+            items.append(element.text)
+        for child in element:
+            items.append(child)
+            if child.tail:
+                items.append(child.tail)
+        return ElementTreeNodeList(node, items)
+
+    def createNode(self, item, parentNode):
+        """
+        Returns the node for a child element or text string, adapters of
+        elements are shared while they are referenced
+
+        :param item:
+        :type item: xml.etree.ElementTree.Element | string
+        :param parentNode:
+        :type parentNode: ElementTreeNode
+        :rtype: ElementTreeNode | StreamNode
+        """
+        if not hasattr(item, 'tag'):
+            return StreamNode(Node.TEXT_NODE, None, item, parentNode)
+        if item.tag is ElementTree.Comment:
+            return StreamNode(Node.COMMENT_NODE, None, item.text, parentNode)
+        if item.tag is ElementTree.PI:
+            return StreamNode(Node.PROCESSING_INSTRUCTION_NODE, None, item.text, parentNode)
+        node = self.nodes.get(item)
+        if node is None:
+            node = ElementTreeNode(self, item, parentNode)
+            self.nodes[item] = node
+        return node
@@ -3,10 +3,19 @@
 
 import unittest
 import logging
+import hashlib
+import glob
 
+from io import BytesIO
 from os.path import join
+from StringIO import StringIO
 from xml.dom.minidom import parseString
-from c14n2py import DOMCanonicalizer, Parameters, QNameAwareParameter
+from xml.etree import ElementTree
+from c14n2py import DOMCanonicalizer, Parameters, QNameAwareParameter, \
+    StreamingCanonicalizer, OutputSink, QNameMatcher, CompiledParameters, \
+    DOMCanonicalizerHandler, DefaultCanonicalizerHandler, canonicalize_many, \
+    ElementTreeCanonicalizer, PrefixesContainer, SubtreeCache, \
+    DocumentCanonicalizationSession, canonicalize_file, PullDOMCanonicalizer
 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -264,6 +273,26 @@ class CanonicalizerTest(unittest.TestCase):
             *self.process_test('inNsContent', 'c14nPrefixQnameXpathElem')
         )
 
+    def testNestedQnameElemText(self):
+        # text after the inner element and inside a plain sibling must use
+        # the QName flags of its own element
+        data = '<r xmlns:a="http://a" xmlns:p="urn:p" xmlns:q="urn:q" xmlns:s="urn:s">' \
+               '<a:bar>p:x<a:bar>q:y</a:bar><a:baz>s:z</a:baz>p:w</a:bar>s:v</r>'
+        expected = {
+            False: '<r><a:bar xmlns:a="http://a" xmlns:p="urn:p">p:x'
+                   '<a:bar xmlns:q="urn:q">q:y</a:bar><a:baz>s:z</a:baz>'
+                   'p:w</a:bar>s:v</r>',
+            True: '<n0:r xmlns:n0=""><n1:bar xmlns:n1="http://a" '
+                  'xmlns:n2="urn:p">n2:x<n1:bar xmlns:n3="urn:q">n3:y'
+                  '</n1:bar><n1:baz>s:z</n1:baz>n2:w</n1:bar>s:v</n0:r>',
+        }
+        for prefixRewrite, result in expected.items():
+            params = get_params('c14nQnameElem')
+            if prefixRewrite:
+                params.prefixRewrite = Parameters.SEQUENTIAL
+            self.assertEqual(DOMCanonicalizer.canonicalize(parseString(data), params), result)
+            self.assertEqual(StreamingCanonicalizer.canonicalize(data, params), result)
+
     def testRC242Default(self):
         self.assertEqual(
             *self.process_test('inRC2_4_2', 'c14nDefault')
@@ -332,5 +361,971 @@ class CanonicalizerTest(unittest.TestCase):
         )
 
 
+class CompiledParametersTest(unittest.TestCase):
+
+    path = './tests/resources/'
+
+    def testCompile(self):
+        compiled = get_params('c14nPrefixQname').compile()
+        self.assertIsInstance(compiled, CompiledParameters)
+        self.assertTrue(compiled.sequential)
+        self.assertTrue(compiled.qnameAware)
+        self.assertEqual(
+            compiled.qnameAwareQualifiedAttributes,
+            {("http://www.w3.org/2001/XMLSchema-instance", "type")}
+        )
+        self.assertIs(compiled.compile(), compiled)
+
+    def testImmutable(self):
+        compiled = get_params('c14nDefault').compile()
+        self.assertFalse(compiled.qnameAware)
+        self.assertRaises(AttributeError, setattr, compiled, 'trimTextNodes', True)
+
+    def testCanonicalize(self):
+        with open(join(self.path, 'inNsXml.xml'), 'r') as f:
+            data = f.read()
+        params = get_params('c14nPrefixQname')
+        compiled = params.compile()
+        for i in range(2):
+            self.assertEqual(
+                DOMCanonicalizer.canonicalize(parseString(data), compiled),
+                DOMCanonicalizer.canonicalize(parseString(data), params)
+            )
+
+
+class DefaultCanonicalizerHandlerTest(unittest.TestCase):
+
+    path = './tests/resources/'
+
+    def testSelection(self):
+        doc = parseString('<a/>')
+        self.assertIsInstance(
+            DOMCanonicalizer(doc, None, None, get_params('c14nTrim')).canonicalizer,
+            DefaultCanonicalizerHandler
+        )
+        for param_set_name in ('c14nPrefix', 'c14nQname'):
+            canonicalizer = DOMCanonicalizer(
+                doc, None, None, get_params(param_set_name)
+            ).canonicalizer
+            self.assertNotIsInstance(canonicalizer, DefaultCanonicalizerHandler)
+
+    def testSameOutput(self):
+        for in_file_name in glob.glob(join(self.path, 'in*.xml')):
+            with open(in_file_name, 'r') as f:
+                doc = parseString(f.read())
+            for param_set_name in ('c14nDefault', 'c14nTrim'):
+                params = get_params(param_set_name)
+                canonicalizer = DOMCanonicalizer(doc, None, None, params)
+                result = canonicalizer.canonicalizeSubTree()
+                canonicalizer.canonicalizer = DOMCanonicalizerHandler(
+                    doc, params, None, StringIO()
+                )
+                self.assertEqual(result, canonicalizer.canonicalizeSubTree())
+
+    def testManyAttributes(self):
+        names = ['a{}'.format(i) for i in range(200)]
+        doc = parseString('<e xmlns:b="urn:b" xmlns:a="urn:a" {} {} {} xml:lang="en"/>'.format(
+            ' '.join('{}="1"'.format(n) for n in reversed(names)),
+            ' '.join('b:{}="2"'.format(n) for n in names[:50]),
+            ' '.join('a:{}="3"'.format(n) for n in names[:50]),
+        ))
+        params = get_params('c14nDefault')
+        canonicalizer = DOMCanonicalizer(doc, None, None, params)
+        result = canonicalizer.canonicalizeSubTree()
+        canonicalizer.canonicalizer = DOMCanonicalizerHandler(
+            doc, params, None, StringIO()
+        )
+        self.assertEqual(result, canonicalizer.canonicalizeSubTree())
+        self.assertTrue(result.startswith(
+            '<e xmlns:a="urn:a" xmlns:b="urn:b" {}'.format(
+                ' '.join('{}="1"'.format(n) for n in sorted(names))
+            )
+        ))
+        self.assertLess(result.index(' a199="1"'), result.index(' a:a0="3"'))
+        self.assertLess(result.index(' a:a49="3"'), result.index(' b:a0="2"'))
+
+    def testRepeatedPrefixedNames(self):
+        data = '<p:r xmlns:p="urn:1"><p:e p:a="1">x</p:e>' \
+               '<p:e xmlns:p="urn:2" p:a="2">y</p:e><p:e p:a="3">z</p:e></p:r>'
+        expected = {
+            'c14nDefault': '<p:r xmlns:p="urn:1"><p:e p:a="1">x</p:e>'
+                           '<p:e xmlns:p="urn:2" p:a="2">y</p:e><p:e p:a="3">z</p:e></p:r>',
+            'c14nPrefix': '<n0:r xmlns:n0="urn:1"><n0:e n0:a="1">x</n0:e>'
+                          '<n1:e xmlns:n1="urn:2" n1:a="2">y</n1:e><n0:e n0:a="3">z</n0:e></n0:r>',
+        }
+        for param_set_name, result in expected.items():
+            doc = parseString(data)
+            canonicalizer = DOMCanonicalizer(doc, None, None, get_params(param_set_name))
+            self.assertEqual(canonicalizer.canonicalizeSubTree(), result)
+            # one entry per distinct name, prefixes rebound on a sibling still
+            # resolve against the scope of the element
+            names = canonicalizer.canonicalizer.names
+            self.assertEqual(set(names), {'p:r', 'p:e', 'p:a', 'xmlns:p'})
+            for element in doc.getElementsByTagName('p:e'):
+                attr = element.getAttributeNode('p:a')
+                self.assertIs(canonicalizer.canonicalizer.splitName(element), names['p:e'])
+                self.assertEqual(names['p:e'], (element.prefix, element.localName))
+                self.assertEqual(names['p:a'], (attr.prefix, attr.localName))
+
+
+class PrefixesContainerTest(unittest.TestCase):
+
+    def testScopes(self):
+        prefixes = PrefixesContainer()
+        prefixes.definePrefix('a', 'urn:a', -1)
+        prefixes.definePrefix('', '', 0)
+        prefixes.definePrefix('a', 'urn:a1', 1)
+        prefixes.definePrefix('b', 'urn:b', 1)
+        prefixes.definePrefix('a', 'urn:a2', 2)
+        self.assertEqual(prefixes.getByFirstKey('a'), 'urn:a2')
+        prefixes.deleteLevel(3)
+        self.assertEqual(prefixes.getByFirstKey('a'), 'urn:a2')
+        prefixes.deleteLevel(2)
+        self.assertEqual(prefixes.getByFirstKey('a'), 'urn:a1')
+        self.assertEqual(prefixes.getByFirstKey('b'), 'urn:b')
+        prefixes.deleteLevel(1)
+        self.assertEqual(prefixes.getByFirstKey('a'), 'urn:a')
+        self.assertIsNone(prefixes.getByFirstKey('b'))
+        self.assertEqual(prefixes.getByFirstKey(''), '')
+
+
+class XPathPrefixTest(unittest.TestCase):
+
+    template = '<x:IncludedXPath xmlns:x="http://www.w3.org/2010/xmldsig2#" ' \
+               'xmlns:a="urn:a" xmlns:b="urn:b">{}</x:IncludedXPath>'
+
+    expression = '/a:x/child::b:y[@z = "c:v" and . = \'d:w\']/a:*'
+
+    def testPrefixRewrite(self):
+        result = DOMCanonicalizer.canonicalize(
+            parseString(self.template.format(self.expression)),
+            get_params('c14nPrefixQnameXpathElem')
+        )
+        self.assertEqual(
+            result,
+            '<n0:IncludedXPath xmlns:n0="http://www.w3.org/2010/xmldsig2#" '
+            'xmlns:n1="urn:a" xmlns:n2="urn:b">'
+            '/n1:x/child::n2:y[@z = &quot;c:v&quot; and . = \'d:w\']/n1:*'
+            '</n0:IncludedXPath>'
+        )
+
+    def testVisibility(self):
+        result = DOMCanonicalizer.canonicalize(
+            parseString(self.template.format('/a:x | //b:y')),
+            get_params('c14nQnameXpathElem')
+        )
+        self.assertTrue(result.startswith(
+            '<x:IncludedXPath xmlns:a="urn:a" xmlns:b="urn:b" '
+            'xmlns:x="http://www.w3.org/2010/xmldsig2#">'
+        ))
+
+    def testLongExpression(self):
+        result = DOMCanonicalizer.canonicalize(
+            parseString(self.template.format(' | '.join([self.expression] * 20000))),
+            get_params('c14nPrefixQnameXpathElem')
+        )
+        self.assertEqual(result.count('/n1:x/child::n2:y'), 20000)
+
+
+class IncludeListTest(unittest.TestCase):
+
+    def testDocumentOrder(self):
+        doc = parseString(
+            '<r><a><b><c>1</c><x>2</x></b></a><d>3</d></r>'
+        )
+        r = doc.documentElement
+        c = r.firstChild.firstChild.firstChild
+        d = r.lastChild
+        result = DOMCanonicalizer.canonicalize(
+            doc, get_params('c14nDefault'), [d, c]
+        )
+        self.assertEqual(result, '<r><a><b><c>1</c></b></a><d>3</d></r>')
+
+    def testExcludedAncestor(self):
+        doc = parseString('<r><s><i>x</i></s><t/></r>')
+        i = doc.getElementsByTagName('i')[0]
+        t = doc.getElementsByTagName('t')[0]
+        params = get_params('c14nDefault')
+        self.assertEqual(
+            DOMCanonicalizer.canonicalize(doc, params, [i], QNameMatcher('s')), ''
+        )
+        self.assertEqual(
+            DOMCanonicalizer.canonicalize(doc, params, [i, t], QNameMatcher('s')),
+            '<r><t></t></r>'
+        )
+        self.assertEqual(
+            DOMCanonicalizer.canonicalize(doc, params, [i, t], [i]), '<r><t></t></r>'
+        )
+
+
+class DocumentCanonicalizationSessionTest(unittest.TestCase):
+
+    path = './tests/resources/'
+
+    def testSameOutput(self):
+        for name in ('inWsse', 'inNsPushdown', 'inNsRedecl', 'inC14N3'):
+            with open(join(self.path, '{}.xml'.format(name)), 'r') as f:
+                doc = parseString(f.read())
+            elements = doc.getElementsByTagName('*')
+            for param_set_name in ('c14nDefault', 'c14nPrefix'):
+                params = get_params(param_set_name)
+                session = DocumentCanonicalizationSession(doc, params)
+                self.assertEqual(
+                    session.canonicalize(),
+                    DOMCanonicalizer.canonicalize(doc, params)
+                )
+                for element in elements:
+                    self.assertEqual(
+                        session.canonicalize(element),
+                        DOMCanonicalizer.canonicalize(element, params)
+                    )
+                    self.assertEqual(
+                        session.canonicalize(includeList=[element]),
+                        DOMCanonicalizer.canonicalize(doc, params, [element])
+                    )
+                self.assertEqual(
+                    session.canonicalize(excludeList=elements[-1:]),
+                    DOMCanonicalizer.canonicalize(doc, params, None, elements[-1:])
+                )
+
+    def testDigest(self):
+        with open(join(self.path, 'inWsse.xml'), 'r') as f:
+            doc = parseString(f.read())
+        session = DocumentCanonicalizationSession(doc)
+        element = doc.documentElement.lastChild.previousSibling
+        self.assertEqual(
+            session.digest(element, params=get_params('c14nPrefix')),
+            DOMCanonicalizer.digest(element, get_params('c14nPrefix'))
+        )
+
+
+class DeepDocumentTest(unittest.TestCase):
+
+    depth = 5000
+
+    def testDeepDocument(self):
+        data = '<a>' + '<b x="1">t' * self.depth + '</b>' * self.depth + '</a>'
+        result = DOMCanonicalizer.canonicalize(
+            parseString(data), get_params('c14nDefault')
+        )
+        self.assertEqual(result, data)
+
+    def testDeepDocumentIncludeList(self):
+        data = '<a>' + '<b>' * self.depth + '</b>' * self.depth + '<c/></a>'
+        doc = parseString(data)
+        result = DOMCanonicalizer.canonicalize(
+            doc, get_params('c14nDefault'), [doc.documentElement.lastChild]
+        )
+        self.assertEqual(result, '<a><c></c></a>')
+
+
+class ExcludeListTest(unittest.TestCase):
+
+    path = './tests/resources/'
+
+    wsu = '{http://docs.oasis-open.org/wss/2004/01/' \
+          'oasis-200401-wss-wssecurity-utility-1.0.xsd}'
+
+    def setUp(self):
+        with open(join(self.path, 'inWsse.xml'), 'r') as f:
+            self.data = f.read()
+        self.doc = parseString(self.data)
+        self.timestamp = self.doc.getElementsByTagName('wsse:Timestamp')[0]
+
+    def testExcludeSet(self):
+        self.assertEqual(
+            DOMCanonicalizer.canonicalize(
+                self.doc, get_params('c14nDefault'),
+                excludeList={self.timestamp}
+            ),
+            DOMCanonicalizer.canonicalize(
+                self.doc, get_params('c14nDefault'),
+                excludeList=[self.timestamp]
+            )
+        )
+
+    def testExcludeMatcher(self):
+        matcher = QNameMatcher(
+            '{http://docs.oasis-open.org/wss/2004/01/'
+            'oasis-200401-wss-wssecurity-secext-1.0.xsd}Timestamp'
+        )
+        self.assertEqual(
+            DOMCanonicalizer.canonicalize(
+                self.doc, get_params('c14nDefault'), excludeList=matcher
+            ),
+            DOMCanonicalizer.canonicalize(
+                self.doc, get_params('c14nDefault'),
+                excludeList=[self.timestamp]
+            )
+        )
+
+    def testExcludeAttributeMatcher(self):
+        result = DOMCanonicalizer.canonicalize(
+            self.doc, get_params('c14nDefault'),
+            excludeList=QNameMatcher(self.wsu + 'Id')
+        )
+        self.assertNotIn('wsu:Id', result)
+        self.assertNotIn('xmlns:wsu', result)
+
+    def testExcludeAttributeNextToDeclarations(self):
+        data = '<r xmlns:a="urn:a" xmlns:b="urn:b" a:x="1" b:y="2" z="3">' \
+               '<a:c b:w="4"/></r>'
+        expected = {
+            # the declaration moves to the first element using the prefix
+            'b:y': '<r xmlns:a="urn:a" z="3" a:x="1">'
+                   '<a:c xmlns:b="urn:b" b:w="4"></a:c></r>',
+            # declarations are namespace scope, not excludable attributes
+            'xmlns:b': '<r xmlns:a="urn:a" xmlns:b="urn:b" z="3" a:x="1" b:y="2">'
+                       '<a:c b:w="4"></a:c></r>',
+            'z': '<r xmlns:a="urn:a" xmlns:b="urn:b" a:x="1" b:y="2">'
+                 '<a:c b:w="4"></a:c></r>',
+        }
+        for name, result in expected.items():
+            doc = parseString(data)
+            attr = doc.documentElement.getAttributeNode(name)
+            self.assertEqual(
+                DOMCanonicalizer.canonicalize(
+                    doc, get_params('c14nDefault'), excludeList=[attr]
+                ),
+                result
+            )
+
+    def testStreamingExcludeMatcher(self):
+        matcher = QNameMatcher(
+            '{http://docs.oasis-open.org/wss/2004/01/'
+            'oasis-200401-wss-wssecurity-secext-1.0.xsd}Timestamp',
+            self.wsu + 'Id'
+        )
+        self.assertEqual(
+            StreamingCanonicalizer.canonicalize(
+                self.data, get_params('c14nPrefix'), excludeFilter=matcher
+            ),
+            DOMCanonicalizer.canonicalize(
+                self.doc, get_params('c14nPrefix'), excludeList=matcher
+            )
+        )
+
+
+class EscapingTest(unittest.TestCase):
+
+    def testAttributeEscaping(self):
+        result = DOMCanonicalizer.canonicalize(
+            parseString('<a b="&#9;&#10;&#13;&lt;>&amp;"/>'),
+            get_params('c14nDefault')
+        )
+        self.assertEqual(
+            result, '<a b="&#x9;&#xA;&#xD;&lt;&gt;&amp;"></a>'
+        )
+
+    def testLargeText(self):
+        text = 'QUJD' * 100000
+        result = DOMCanonicalizer.canonicalize(
+            parseString('<a>{}&#13;&amp;</a>'.format(text)),
+            get_params('c14nDefault')
+        )
+        self.assertEqual(result, '<a>{}&#xD;&amp;</a>'.format(text))
+
+
+class XmlSpaceTest(unittest.TestCase):
+
+    data = '<a xml:space="preserve"> <b> x <d> z </d></b>' \
+           '<c xml:space="default"> y <d> z </d></c></a>'
+
+    expected = '<a xml:space="preserve"> <b> x <d> z </d></b>' \
+               '<c xml:space="default">y<d>z</d></c></a>'
+
+    def testInheritedScope(self):
+        for param_set_name in ('c14nTrim', 'c14nPrefix'):
+            params = get_params(param_set_name)
+            params.trimTextNodes = True
+            result = DOMCanonicalizer.canonicalize(parseString(self.data), params)
+            if param_set_name == 'c14nTrim':
+                self.assertEqual(result, self.expected)
+            self.assertEqual(
+                result, StreamingCanonicalizer.canonicalize(self.data, params)
+            )
+
+    def testSubTree(self):
+        doc = parseString(self.data)
+        b, c = doc.documentElement.getElementsByTagName('d')
+        params = get_params('c14nTrim')
+        self.assertEqual(DOMCanonicalizer.canonicalize(b, params), '<d> z </d>')
+        self.assertEqual(DOMCanonicalizer.canonicalize(c, params), '<d>z</d>')
+
+
+class StreamingCanonicalizerTest(unittest.TestCase):
+
+    maxDiff = None
+
+    path = './tests/resources/'
+
+    def process_test(self, in_file_name, param_set_name):
+        """ helper function returns streaming and DOM results """
+        with open(join(self.path, '{}.xml'.format(in_file_name)), 'r') as f:
+            data = f.read()
+        result = StreamingCanonicalizer.canonicalize(
+            data, get_params(param_set_name)
+        )
+        reference = DOMCanonicalizer.canonicalize(
+            parseString(data), get_params(param_set_name)
+        )
+        return result, reference
+
+    def testN2Default(self):
+        self.assertEqual(
+            *self.process_test('inC14N2', 'c14nDefault')
+        )
+
+    def testN21Trim(self):
+        self.assertEqual(
+            *self.process_test('inC14N2_1', 'c14nTrim')
+        )
+
+    def testN3Prefix(self):
+        self.assertEqual(
+            *self.process_test('inC14N3', 'c14nPrefix')
+        )
+
+    def testNsPushdownPrefix(self):
+        self.assertEqual(
+            *self.process_test('inNsPushdown', 'c14nPrefix')
+        )
+
+    def testNsXmlPrefixQname(self):
+        self.assertEqual(
+            *self.process_test('inNsXml', 'c14nPrefixQname')
+        )
+
+    def testWsseDefault(self):
+        self.assertEqual(
+            *self.process_test('inWsse', 'c14nDefault')
+        )
+
+    def testNsContentQnameElem(self):
+        self.assertEqual(
+            *self.process_test('inNsContent', 'c14nQnameElem')
+        )
+
+    def testNsContentQnameXpathElem(self):
+        self.assertEqual(
+            *self.process_test('inNsContent', 'c14nQnameXpathElem')
+        )
+
+    def testNsContentPrefixQnameXpathElem(self):
+        self.assertEqual(
+            *self.process_test('inNsContent', 'c14nPrefixQnameXpathElem')
+        )
+
+    def testNsContent1QnameXpathElem(self):
+        self.assertEqual(
+            *self.process_test('inNsContent_1', 'c14nQnameXpathElem')
+        )
+
+    def testNsContent1PrefixQnameXpathElem(self):
+        self.assertEqual(
+            *self.process_test('inNsContent_1', 'c14nPrefixQnameXpathElem')
+        )
+
+    def testFileSource(self):
+        with open(join(self.path, 'inWsse.xml'), 'r') as f:
+            result = StreamingCanonicalizer.canonicalize(
+                f, get_params('c14nPrefix')
+            )
+        self.assertEqual(
+            result, self.process_test('inWsse', 'c14nPrefix')[1]
+        )
+
+    def testUnicodeSource(self):
+        data = u'<a xmlns="http://a" b="\u00e9\u20ac">\u00e9 \u4e2d</a>'
+        result = StreamingCanonicalizer.canonicalize(data, get_params('c14nDefault'))
+        self.assertEqual(
+            result,
+            DOMCanonicalizer.canonicalize(
+                parseString(data.encode('utf-8')), get_params('c14nDefault')
+            )
+        )
+        self.assertIn(u'\u4e2d', result)
+
+    def testCDataAndComments(self):
+        result = StreamingCanonicalizer.canonicalize(
+            '<a xmlns="http://a">t<![CDATA[<x>]]>u<!--c-->w</a>',
+            get_params('c14nDefault')
+        )
+        self.assertEqual(result, '<a xmlns="http://a">t&lt;x>uw</a>')
+
+    def testCanonicalizeFile(self):
+        result = canonicalize_file(
+            join(self.path, 'inWsse.xml'), get_params('c14nPrefix')
+        )
+        self.assertEqual(
+            result, self.process_test('inWsse', 'c14nPrefix')[1]
+        )
+
+    def testCanonicalizeFileQNameAware(self):
+        for param_set_name in ('c14nQnameXpathElem', 'c14nPrefixQnameXpathElem'):
+            result = canonicalize_file(
+                join(self.path, 'inNsContent.xml'), get_params(param_set_name)
+            )
+            self.assertEqual(
+                result, self.process_test('inNsContent', param_set_name)[1]
+            )
+
+    def testCanonicalizeFileSlices(self):
+        out = BytesIO()
+        readSize = StreamingCanonicalizer.READ_SIZE
+        StreamingCanonicalizer.READ_SIZE = 7
+        try:
+            canonicalize_file(
+                join(self.path, 'inNsPushdown.xml'),
+                get_params('c14nPrefix'), out=out, bufferSize=64
+            )
+        finally:
+            StreamingCanonicalizer.READ_SIZE = readSize
+        self.assertEqual(
+            out.getvalue().decode('utf-8'),
+            self.process_test('inNsPushdown', 'c14nPrefix')[1]
+        )
+
+
+class PullDOMCanonicalizerTest(unittest.TestCase):
+
+    path = './tests/resources/'
+
+    WSSE_NS = 'http://docs.oasis-open.org/wss/2004/01/' \
+              'oasis-200401-wss-wssecurity-secext-1.0.xsd'
+
+    def setUp(self):
+        with open(join(self.path, 'inWsse.xml'), 'r') as f:
+            self.data = f.read()
+        self.doc = parseString(self.data)
+
+    def reference(self, localName, param_set_name):
+        node = self.doc.getElementsByTagNameNS(self.WSSE_NS, localName)[0]
+        return DOMCanonicalizer.canonicalize(node, get_params(param_set_name))
+
+    def testNames(self):
+        for param_set_name in ('c14nDefault', 'c14nPrefix', 'c14nTrim'):
+            result = PullDOMCanonicalizer.canonicalize(
+                self.data, get_params(param_set_name),
+                names=['{%s}Timestamp' % self.WSSE_NS,
+                       '{%s}UserName' % self.WSSE_NS]
+            )
+            self.assertEqual(result, [
+                self.reference('UserName', param_set_name),
+                self.reference('Timestamp', param_set_name),
+            ])
+
+    def testIds(self):
+        result = PullDOMCanonicalizer.canonicalize(
+            self.data, get_params('c14nDefault'), ids=['i2']
+        )
+        self.assertEqual(result, [self.reference('Timestamp', 'c14nDefault')])
+
+    def testNestedTargets(self):
+        canonicalizer = PullDOMCanonicalizer(
+            get_params('c14nDefault'), ids=['i1'],
+            names=['{%s}Security' % self.WSSE_NS]
+        )
+        with open(join(self.path, 'inWsse.xml'), 'r') as f:
+            targets = list(canonicalizer.iterTargets(f))
+        self.assertEqual(len(targets), 1)
+        self.assertEqual(targets[0][0].localName, 'Security')
+        self.assertEqual(targets[0][1], self.reference('Security', 'c14nDefault'))
+
+    def testXmlSpace(self):
+        result = PullDOMCanonicalizer.canonicalize(
+            XmlSpaceTest.data, get_params('c14nTrim'), names=['d']
+        )
+        self.assertEqual(result, ['<d> z </d>', '<d>z</d>'])
+
+    def assertDOMResult(self, data, names, param_set_name='c14nDefault'):
+        doc = parseString(data)
+        reference = [
+            DOMCanonicalizer.canonicalize(node, get_params(param_set_name))
+            for node in doc.getElementsByTagName('*')
+            if QNameMatcher(*names)(node)
+        ]
+        self.assertEqual(
+            PullDOMCanonicalizer.canonicalize(
+                data, get_params(param_set_name), names=names
+            ),
+            reference
+        )
+
+    def testAttributePrefix(self):
+        self.assertDOMResult(
+            '<r xmlns:b="urn:z"><e xmlns="urn:z" b:a="1"/></r>', ['{urn:z}e']
+        )
+
+    def testSharedNamespace(self):
+        self.assertDOMResult(
+            '<r xmlns="urn:y" xmlns:c="urn:y"><c:e>t</c:e></r>', ['{urn:y}r']
+        )
+        self.assertDOMResult(
+            '<r xmlns="urn:y" xmlns:c="urn:y"><c:e>t</c:e></r>', ['{urn:y}e'],
+            'c14nPrefix'
+        )
+
+    def testCData(self):
+        data = '<r><e>a <![CDATA[ x ]]> b</e></r>'
+        for param_set_name in ('c14nDefault', 'c14nTrim'):
+            self.assertDOMResult(data, ['e'], param_set_name)
+
+    def testReadSize(self):
+        canonicalizer = PullDOMCanonicalizer(
+            get_params('c14nDefault'), ids=['i2']
+        )
+        with open(join(self.path, 'inWsse.xml'), 'r') as f:
+            (node, text), = canonicalizer.iterTargets(f, readSize=16)
+        self.assertEqual(text, self.reference('Timestamp', 'c14nDefault'))
+
+
+class ElementTreeCanonicalizerTest(unittest.TestCase):
+
+    maxDiff = None
+
+    path = './tests/resources/'
+
+    def process_test(self, in_file_name, param_set_name):
+        """ helper function returns ElementTree and DOM results """
+        with open(join(self.path, '{}.xml'.format(in_file_name)), 'rb') as f:
+            data = f.read()
+        result = ElementTreeCanonicalizer.parse(data).canonicalize(
+            get_params(param_set_name)
+        )
+        reference = DOMCanonicalizer.canonicalize(
+            parseString(data), get_params(param_set_name)
+        )
+        return result, reference
+
+    def testN2Default(self):
+        self.assertEqual(
+            *self.process_test('inC14N2', 'c14nDefault')
+        )
+
+    def testN21Trim(self):
+        self.assertEqual(
+            *self.process_test('inC14N2_1', 'c14nTrim')
+        )
+
+    def testNsPushdownPrefix(self):
+        self.assertEqual(
+            *self.process_test('inNsPushdown', 'c14nPrefix')
+        )
+
+    def testNsRedeclDefault(self):
+        self.assertEqual(
+            *self.process_test('inNsRedecl', 'c14nDefault')
+        )
+
+    def testNsXmlPrefixQname(self):
+        self.assertEqual(
+            *self.process_test('inNsXml', 'c14nPrefixQname')
+        )
+
+    def testWsseDefault(self):
+        self.assertEqual(
+            *self.process_test('inWsse', 'c14nDefault')
+        )
+
+    def testNsSuperfluousDefault(self):
+        self.assertEqual(
+            *self.process_test('inNsSuperfluous', 'c14nDefault')
+        )
+
+    def testSharedNamespacePrefixes(self):
+        data = b'<r xmlns="urn:y" xmlns:c="urn:y" xmlns:d="urn:y">' \
+               b'<c:e d:a="1" c:b="2"/><e/></r>'
+        for param_set_name in ('c14nDefault', 'c14nPrefix'):
+            self.assertEqual(
+                ElementTreeCanonicalizer.parse(data).canonicalize(
+                    get_params(param_set_name)
+                ),
+                DOMCanonicalizer.canonicalize(
+                    parseString(data), get_params(param_set_name)
+                )
+            )
+
+    def testAmbiguousPrefixWithoutParser(self):
+        root = ElementTree.fromstring(
+            '<r xmlns:c="urn:y" xmlns:d="urn:y"><c:e/></r>'
+        )
+        canonicalizer = ElementTreeCanonicalizer(
+            root, {root: [('c', 'urn:y'), ('d', 'urn:y')]}
+        )
+        self.assertRaises(
+            Exception, canonicalizer.canonicalize, get_params('c14nDefault')
+        )
+
+    def testChildNodesBuiltOncePerElement(self):
+        built = list()
+
+        class CountingCanonicalizer(ElementTreeCanonicalizer):
+            def createChildNodes(self, node):
+                built.append(node.element)
+                return ElementTreeCanonicalizer.createChildNodes(self, node)
+
+        data = b'<r><a>x<b/>y</a><a>x<b/>y</a><c/></r>'
+        parsed = ElementTreeCanonicalizer.parse(data)
+        canonicalizer = CountingCanonicalizer(
+            parsed.root, parsed.namespaces, parsed.sourcePrefixes
+        )
+        self.assertEqual(
+            canonicalizer.canonicalize(
+                get_params('c14nDefault'), cache=SubtreeCache(lambda node: True)
+            ),
+            DOMCanonicalizer.canonicalize(parseString(data), get_params('c14nDefault'))
+        )
+        # once by the walker and once by the subtree digest
+        self.assertEqual(max(built.count(e) for e in set(built)), 2)
+
+    def testAdaptersReleased(self):
+        with open(join(self.path, 'inWsse.xml'), 'rb') as f:
+            canonicalizer = ElementTreeCanonicalizer.parse(f)
+        canonicalizer.canonicalize(get_params('c14nPrefix'))
+        self.assertEqual(len(canonicalizer.nodes), 0)
+
+    def testSubTreeLists(self):
+        with open(join(self.path, 'inWsse.xml'), 'rb') as f:
+            data = f.read()
+        canonicalizer = ElementTreeCanonicalizer.parse(BytesIO(data))
+        doc = parseString(data)
+        ns = 'http://docs.oasis-open.org/wss/2004/01/' \
+             'oasis-200401-wss-wssecurity-secext-1.0.xsd'
+        user = canonicalizer.root.find('{%s}UserName' % ns)
+        timestamp = canonicalizer.root.find('{%s}Timestamp' % ns)
+        self.assertEqual(
+            canonicalizer.canonicalize(get_params('c14nPrefix'), user),
+            DOMCanonicalizer.canonicalize(
+                doc.getElementsByTagNameNS(ns, 'UserName')[0],
+                get_params('c14nPrefix')
+            )
+        )
+        self.assertEqual(
+            canonicalizer.canonicalize(
+                get_params('c14nDefault'), includeList=[timestamp],
+                excludeList=[user]
+            ),
+            DOMCanonicalizer.canonicalize(
+                doc, get_params('c14nDefault'),
+                [doc.getElementsByTagNameNS(ns, 'Timestamp')[0]],
+                [doc.getElementsByTagNameNS(ns, 'UserName')[0]]
+            )
+        )
+
+
+class SubtreeCacheTest(unittest.TestCase):
+
+    template = '<s:Envelope xmlns:s="urn:s" xmlns:t="urn:t"><s:Header>' \
+               '<t:Token t:Id="x">{}</t:Token><t:Token t:Id="y">abc</t:Token>' \
+               '</s:Header><s:Body>{}</s:Body></s:Envelope>'
+
+    def setUp(self):
+        self.cache = SubtreeCache(QNameMatcher('{urn:t}Token'))
+
+    def canonicalize(self, data, param_set_name='c14nDefault'):
+        result = DOMCanonicalizer.canonicalize(
+            parseString(data), get_params(param_set_name), cache=self.cache
+        )
+        reference = DOMCanonicalizer.canonicalize(
+            parseString(data), get_params(param_set_name)
+        )
+        self.assertEqual(result, reference)
+        return result
+
+    def testRepeatedFragments(self):
+        self.canonicalize(self.template.format('token', 'body 1'))
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+        self.canonicalize(self.template.format('token', 'body 2'))
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 2))
+        self.canonicalize(self.template.format('changed', 'body 2'))
+        self.assertEqual((self.cache.hits, self.cache.misses), (3, 3))
+
+    def testNamespaceContext(self):
+        self.canonicalize(self.template.format('token', 'body'))
+        self.canonicalize(
+            '<t:Token xmlns:t="urn:t" t:Id="x">token</t:Token>'
+        )
+        self.canonicalize(
+            '<x xmlns:t="urn:other"><t:Token xmlns:t="urn:t" t:Id="x">token</t:Token></x>'
+        )
+        self.assertEqual(self.cache.hits, 0)
+
+    def testBudget(self):
+        self.cache.maxBytes = 100
+        for i in range(10):
+            self.canonicalize(self.template.format('token {}'.format(i), ''))
+        self.assertLessEqual(self.cache.size, 100)
+        self.assertEqual(len(self.cache.entries), 2)
+
+    def testEmptyNamespace(self):
+        self.cache = SubtreeCache(lambda node: True)
+        with open(join('./tests/resources/', 'inC14N3.xml'), 'r') as f:
+            data = f.read()
+        self.canonicalize(data)
+        self.canonicalize(data)
+        self.assertTrue(self.cache.hits > 0)
+
+    def testNestedMatches(self):
+        self.cache = SubtreeCache(QNameMatcher('e'))
+        data = '<r>' + '<e><x/>' * 50 + '</e>' * 50 + '</r>'
+        self.canonicalize(data)
+        self.canonicalize(data)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 50))
+
+    def testBypass(self):
+        self.canonicalize(self.template.format('token', ''), 'c14nPrefix')
+        self.canonicalize(self.template.format('token', ''), 'c14nPrefix')
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 0))
+
+
+class OutputSinkTest(unittest.TestCase):
+
+    path = './tests/resources/'
+
+    def setUp(self):
+        with open(join(self.path, 'inWsse.xml'), 'r') as f:
+            self.data = f.read()
+        self.reference = DOMCanonicalizer.canonicalize(
+            parseString(self.data), get_params('c14nPrefix')
+        ).encode('utf-8')
+
+    def testFileSink(self):
+        out = BytesIO()
+        result = DOMCanonicalizer.canonicalize(
+            parseString(self.data), get_params('c14nPrefix'), out=out,
+            bufferSize=64
+        )
+        self.assertIsNone(result)
+        self.assertEqual(out.getvalue(), self.reference)
+
+    def testHashSink(self):
+        h = hashlib.sha1()
+        DOMCanonicalizer.canonicalize(
+            parseString(self.data), get_params('c14nPrefix'), out=h
+        )
+        self.assertEqual(h.digest(), hashlib.sha1(self.reference).digest())
+
+    def testStreamingSink(self):
+        out = BytesIO()
+        StreamingCanonicalizer.canonicalize(
+            self.data, get_params('c14nPrefix'), out=out, bufferSize=64
+        )
+        self.assertEqual(out.getvalue(), self.reference)
+
+    def testIterCanonicalize(self):
+        chunks = list(DOMCanonicalizer.iter_canonicalize(
+            parseString(self.data), get_params('c14nPrefix'), bufferSize=64
+        ))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(b''.join(chunks), self.reference)
+
+    def testDigest(self):
+        result = DOMCanonicalizer.digest(
+            parseString(self.data), get_params('c14nPrefix')
+        )
+        self.assertEqual(result, hashlib.sha256(self.reference).digest())
+
+    def testDigestAlgorithm(self):
+        result = DOMCanonicalizer.digest(
+            parseString(self.data), get_params('c14nPrefix'), 'sha1'
+        )
+        self.assertEqual(result, hashlib.sha1(self.reference).digest())
+
+    def testBytearraySink(self):
+        out = bytearray()
+        DOMCanonicalizer.canonicalize(
+            parseString(self.data), get_params('c14nPrefix'), out=out,
+            bufferSize=64
+        )
+        self.assertEqual(bytes(out), self.reference)
+
+    def testCanonicalizeBytes(self):
+        result = DOMCanonicalizer.canonicalize_bytes(
+            parseString(self.data), get_params('c14nPrefix'), bufferSize=64
+        )
+        self.assertIsInstance(result, bytearray)
+        self.assertEqual(result, self.reference)
+
+    def testStreamingCanonicalizeBytes(self):
+        result = StreamingCanonicalizer.canonicalize_bytes(
+            self.data, get_params('c14nPrefix')
+        )
+        self.assertIsInstance(result, bytearray)
+        self.assertEqual(result, self.reference)
+
+    def testWrongTarget(self):
+        self.assertRaises(TypeError, OutputSink, object())
+
+
+class CanonicalizeManyTest(unittest.TestCase):
+
+    path = './tests/resources/'
+
+    def setUp(self):
+        self.documents = []
+        for name in ('inWsse', 'inNsPushdown', 'inC14N3'):
+            with open(join(self.path, '{}.xml'.format(name)), 'rb') as f:
+                self.documents.append(f.read())
+        self.documents.append(b'<broken>')
+        self.params = get_params('c14nPrefix')
+        self.references = [
+            DOMCanonicalizer.canonicalize(
+                parseString(data), self.params
+            ).encode('utf-8')
+            for data in self.documents[:-1]
+        ]
+
+    def testOrdered(self):
+        results = list(canonicalize_many(
+            self.documents * 3, self.params, workers=2, chunksize=2
+        ))
+        self.assertEqual([r.index for r in results], list(range(12)))
+        for result in results:
+            if result.index % 4 == 3:
+                self.assertIsNone(result.value)
+                self.assertTrue(result.error.startswith('ExpatError'))
+            else:
+                self.assertIsNone(result.error)
+                self.assertEqual(result.value, self.references[result.index % 4])
+
+    def testUnordered(self):
+        results = canonicalize_many(
+            self.documents, self.params, workers=2, ordered=False
+        )
+        self.assertEqual(sorted(r.index for r in results), list(range(4)))
+
+    def testDigestInProcess(self):
+        results = list(canonicalize_many(
+            self.documents, self.params, workers=1, algorithm='sha256'
+        ))
+        for reference, result in zip(self.references, results):
+            self.assertEqual(result.value, hashlib.sha256(reference).digest())
+        self.assertIsNotNone(results[-1].error)
+
+    def testUnicodeDocument(self):
+        data = u'<m:msg xmlns:m="urn:m" m:to="J\u00fcrgen">\u00e9t\u00e9 \u20ac</m:msg>'
+        reference = DOMCanonicalizer.canonicalize(
+            parseString(data.encode('utf-8')), self.params
+        ).encode('utf-8')
+        result, = canonicalize_many([data], self.params, workers=1)
+        self.assertIsNone(result.error)
+        self.assertEqual(result.value, reference)
+        result, = canonicalize_many([data], self.params, workers=2)
+        self.assertEqual(result.value, reference)
+
+    def testQNameAwareParams(self):
+        with open(join(self.path, 'inNsContent.xml'), 'rb') as f:
+            data = f.read()
+        for param_set_name in ('c14nQnameElem', 'c14nPrefixQnameXpathElem'):
+            params = get_params(param_set_name)
+            reference = DOMCanonicalizer.canonicalize(
+                parseString(data), params
+            ).encode('utf-8')
+            result, = canonicalize_many([data], params, workers=1)
+            self.assertIsNone(result.error)
+            self.assertEqual(result.value, reference)
+
+
 if __name__ == '__main__':
     unittest.main()